@@ -1,21 +1,39 @@
 # -*- coding: utf-8 -*-
+import itertools
 import json
-import re
+import logging
+import os
+import random
+import threading
 from datetime import datetime
 from urllib.parse import urlencode, urlparse, parse_qs
 
 import scrapy
-from bs4 import BeautifulSoup as bs
-from scrapy import Request, FormRequest
-from medical_scraper.scrap_aws_ses import send_emails
+from scrapy import Request, FormRequest, signals
+from scrapy.downloadermiddlewares.cookies import CookiesMiddleware
+from scrapy.exceptions import DontCloseSpider
+from scrapy.spidermiddlewares.httperror import HttpError
+from scrapy.utils.defer import maybe_deferred_to_future
+from scrapy.utils.misc import arg_to_iter
+from twisted.internet import defer, task, threads
+from twisted.python.failure import Failure
 import platform
 
-from medical_scraper.zmq_client import ZMQClient
-from .tmhp import Tmhp
+from . import mcna_parsers
+from .mcna_items import MemberRecord, StatusEvent
+from .mcna_logging import BodyPreview, ResponseCapture
+from .mcna_metrics import CallbackTimerMiddleware, CrawlMetrics, callback_name, record_callback_time
+from .mcna_middlewares import AccountSlotMiddleware, AccountThrottleMiddleware, EndpointCacheMiddleware, \
+    RequestClassMiddleware
+from .mcna_pipelines import StreamingExportPipeline
+from .mcna_shards import parse_shard, shard_of
+from .mcna_stores import CheckMemo, MemberCache, ProgressStore, ResponseCache, SessionStore
 import time
 
 html_render_url = 'http://127.0.0.1:9000/htmltopdf'
 hostname = platform.node()
+# Sent with item and reply when an eligibility PDF render completes
+pdf_rendered = object()
 
 
 def build_url(url, params=dict()):
@@ -23,6 +41,17 @@ def build_url(url, params=dict()):
 
 output_date_format = '%m/%d/%Y'
 input_date_format = '%Y-%m-%d'
+roster_letters = [chr(i) for i in range(ord('a'), ord('z') + 1)]
+
+
+# JSON spider argument given inline or as @path to a file, already decoded values pass through
+def load_json_arg(value):
+    if not isinstance(value, str):
+        return value
+    if value.startswith('@'):
+        with open(value[1:], encoding='utf-8') as f:
+            return json.load(f)
+    return json.loads(value)
 
 
 def convert_date(date):
@@ -34,6 +63,138 @@ def convert_date(date):
         return ''
 
 
+retry_base_delay = 5
+retry_max_delay = 60
+
+
+# Exponential backoff with jitter so retries of concurrent members don't fire in lockstep
+def backoff_delay(attempt):
+    delay = min(retry_max_delay, retry_base_delay * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+# SES alert sink, the AWS client is only imported once the first alert goes out
+def ses_sink(subject, body):
+    from medical_scraper.scrap_aws_ses import send_emails
+    return send_emails(subject=subject, body=body)
+
+
+# ZMQ render client, zmq is only imported by runs that render PDFs
+def zmq_client():
+    from medical_scraper.zmq_client import ZMQClient
+    return ZMQClient()
+
+
+class LogAlertSink(object):
+    # Local stand-in for SES: keeps sent alerts in memory and logs them
+    def __init__(self, logger):
+        self.logger = logger
+        self.sent = []
+
+    def __call__(self, subject, body):
+        self.sent.append((subject, body))
+        self.logger.warning('Alert "{}":\n{}'.format(subject, body))
+
+
+class AlertDispatcher(object):
+    # Group alerts by subject over a time window and send one digest per subject from a worker thread,
+    # so error paths never wait on SES from the reactor thread
+    max_digest_bodies = 20
+
+    def __init__(self, logger, sink=ses_sink, window=60, min_interval=300):
+        self.logger = logger
+        self.sink = sink
+        self.window = window
+        self.min_interval = min_interval
+        self.pending = dict()
+        self.scheduled = dict()
+        self.last_sent = dict()
+        self.in_flight = set()
+
+    def send(self, subject, body):
+        self.pending.setdefault(subject, []).append(body)
+        if subject not in self.scheduled:
+            # Rate limit per subject: never flush sooner than min_interval after the previous digest
+            next_allowed = self.last_sent.get(subject, 0) + self.min_interval
+            delay = max(self.window, next_allowed - time.time())
+            from twisted.internet import reactor
+            self.scheduled[subject] = reactor.callLater(delay, self.flush, subject)
+
+    def flush(self, subject):
+        call = self.scheduled.pop(subject, None)
+        if call and call.active():
+            call.cancel()
+        bodies = self.pending.pop(subject, [])
+        if not bodies:
+            return defer.succeed(None)
+        if len(bodies) == 1:
+            body = bodies[0]
+        else:
+            body = '{} alerts on host {}:\n\n{}'.format(
+                len(bodies), hostname, '\n\n'.join(bodies[:self.max_digest_bodies]))
+            if len(bodies) > self.max_digest_bodies:
+                body += '\n\n... and {} more'.format(len(bodies) - self.max_digest_bodies)
+        self.last_sent[subject] = time.time()
+        d = threads.deferToThread(self.sink, subject=subject, body=body)
+        d.addErrback(lambda failure: self.logger.error('Failed to send alert %r: %s', subject, failure))
+        d.addBoth(lambda _: self.in_flight.discard(d))
+        self.in_flight.add(d)
+        return d
+
+    # Send everything still queued, waiting for in-flight digests to finish
+    def close(self):
+        for subject in list(self.pending):
+            self.flush(subject)
+        return defer.DeferredList(list(self.in_flight))
+
+
+class FakeRenderClient(object):
+    # Local stand-in for the ZMQ render service, replies ok after a fixed latency
+    def __init__(self, latency=0.5):
+        self.latency = latency
+
+    def send(self, json_data):
+        time.sleep(self.latency)
+        return {'status': 'ok', 'request_id': json_data.get('request_id'), 'name': json_data.get('name')}
+
+
+class AsyncRenderer(object):
+    # Pipeline HTML->PDF renders through worker threads with a bounded in-flight window.
+    # ZMQ sockets are not thread safe so every worker thread gets its own client.
+    def __init__(self, client_factory=zmq_client, window=4):
+        self.client_factory = client_factory
+        self.semaphore = defer.DeferredSemaphore(window)
+        self.local = threading.local()
+        self.ids = itertools.count(1)
+        self.in_flight = dict()
+
+    def render(self, json_data):
+        request_id = next(self.ids)
+        json_data = dict(json_data, request_id=request_id)
+        d = self.semaphore.run(threads.deferToThread, self._send, json_data)
+        self.in_flight[request_id] = d
+        d.addBoth(self._done, request_id)
+        return d
+
+    def _send(self, json_data):
+        if not hasattr(self.local, 'client'):
+            self.local.client = self.client_factory()
+        reply = self.local.client.send(json_data)
+        # Replies that echo an id must match the request they answer
+        if reply and reply.get('request_id', json_data['request_id']) != json_data['request_id']:
+            raise ValueError('Render reply {} does not match request {}'.format(reply.get('request_id'),
+                                                                               json_data['request_id']))
+        return reply
+
+    def _done(self, result, request_id):
+        self.in_flight.pop(request_id, None)
+        return result
+
+    # Wait for renders still in flight
+    def close(self):
+        return defer.DeferredList(list(self.in_flight.values()))
+
+
 class McnaSpider(scrapy.Spider):
     name = 'mcna'
     allowed_domains = ['mcna.net', 'localhost', '127.0.0.1', 'xxxxx.com']
@@ -47,45 +208,228 @@ class McnaSpider(scrapy.Spider):
     member_eligibility_url = base_url + '/provider/eligible/{}/{}/{}/{}/0/1'
     start_urls = [base_url]
 
-    custom_settings = {}
+    custom_settings = {
+        # Pick the next request from the account slot with the fewest downloads in progress
+        'SCHEDULER_PRIORITY_QUEUE': 'scrapy.pqueues.DownloaderAwarePriorityQueue',
+    }
+    # Added to the project's components by update_settings rather than replacing them through custom_settings
+    components = {
+        # Interactive requests are raised by REQUEST_CLASS_PRIORITY over bulk roster traffic
+        'SPIDER_MIDDLEWARES': {AccountSlotMiddleware: 50, RequestClassMiddleware: 60, CallbackTimerMiddleware: 1000},
+        # The throttle sits above RetryMiddleware (550) so it sees throttling responses and download errors
+        # before they are retried, the cache below HttpCompressionMiddleware so decompressed bodies are cached
+        'DOWNLOADER_MIDDLEWARES': {AccountThrottleMiddleware: 570,
+                                   EndpointCacheMiddleware: 580},
+        # Set MCNA_METRICS_FILE (or -a metrics_file=) to dump Prometheus text at close
+        'EXTENSIONS': {CrawlMetrics: 500},
+        # Set MCNA_EXPORT_URI to stream member records to ndjson or sqlite
+        'ITEM_PIPELINES': {StreamingExportPipeline: 900},
+    }
+    # Retry budgets per request and per cookiejar (one account session)
+    max_retries = 4
+    max_jar_retries = 50
+    # 'probe' fetches the unfiltered roster first, 'letters' always sends one request per alphabet
+    roster_mode = 'probe'
+    # The portal truncates roster lists at this many records
+    roster_page_limit = 500
+    # Kept apart from Scrapy's own 'retry_times' so download retries don't eat the parse budget
+    retry_meta_key = 'parse_retry_times'
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super(McnaSpider, cls).from_crawler(crawler, *args, **kwargs)
+        crawler.signals.connect(spider.spider_idle, signal=signals.spider_idle)
+        return spider
 
-    def __init__(self, creds='', scrape_mode='all', members='', *args, **kwargs):
+    @classmethod
+    def update_settings(cls, settings):
+        super(McnaSpider, cls).update_settings(settings)
+        for name, components in cls.components.items():
+            merged = settings.getdict(name)
+            merged.update(components)
+            settings.set(name, merged, priority='spider')
+
+    def __init__(self, creds='', scrape_mode='all', members='', alert_sink='ses', renderer='zmq', render_window=4,
+                 member_cache='', member_cache_ttl=86400, shard='', session_store='', response_cache='',
+                 response_cache_ttl=600, response_cache_mb=256, tmhp_memo='', tmhp_memo_ttl=86400,
+                 capture_dir='', portal_url='', parse_workers=0, progress='', resume=False, *args, **kwargs):
         super(McnaSpider, self).__init__(*args, **kwargs)
-        self.creds = creds
+        # Point the spider at another portal, e.g. the local mock portal of mcna_bench
+        if portal_url:
+            for name in ('login_url', 'roster_url', 'members_url', 'member_info_url', 'verify_eligibility_url',
+                         'member_eligibility_url', 'base_url'):
+                setattr(self, name, getattr(self, name).replace(McnaSpider.base_url, portal_url, 1))
+            self.start_urls = [self.base_url]
         self.scrape_mode = scrape_mode
-        self.creds = json.loads(self.creds) if isinstance(self.creds, str) else self.creds
+        self.creds = load_json_arg(creds)
+        # Job level settings (TMHP account, practice) come from the first credential of the whole job
+        self.job_creds = self.creds[0]
         self.members = members
-        self.counter = 0
-        self.zclient = ZMQClient()
-        tmhp_username = self.creds[0]['tmhp_username']
-        tmhp_password = self.creds[0]['tmhp_password']
+        self.jar_retries = dict()
+        # Retries waiting out their backoff delay before they are handed back to the engine
+        self.delayed_retries = set()
+        self.alerts = AlertDispatcher(self.logger, sink=LogAlertSink(self.logger) if alert_sink == 'log' else ses_sink)
+        # Only partial mode renders PDFs, the renderer is created on the first render
+        self.render_client = FakeRenderClient if renderer == 'fake' else zmq_client
+        self.render_window = int(render_window)
+        self._renderer = None
+        # Incremental roster sync: all mode skips get_member_info for members fetched within the TTL, partial mode
+        # looks up the mids of members given without one
+        if member_cache and scrape_mode in ('all', 'partial'):
+            self.member_cache = MemberCache(member_cache, ttl=int(member_cache_ttl))
+        else:
+            self.member_cache = None
+        # Repeat checks of the same member within the TTL skip the member info, eligibility and print fetches
+        if response_cache:
+            self.response_cache = ResponseCache(response_cache, ttl=int(response_cache_ttl),
+                                                max_bytes=int(response_cache_mb) * 1024 * 1024)
+        else:
+            self.response_cache = None
+        # Roster, eligibility and print pages are parsed in this many worker processes, inline when 0
+        self.parse_pool = mcna_parsers.ParsePool(int(parse_workers), record=self.record_parse_time)
+        # Full bodies of unexpected responses are only kept when a capture directory is given
+        self.capture = ResponseCapture(capture_dir) if capture_dir else None
+        # Reuse authenticated sessions from earlier runs, cookies are encrypted with MCNA_SESSION_KEY. Validate mode
+        # checks the credentials themselves, so it always goes through the full login.
+        self.sessions = None
+        self.logged_in = set()
+        if session_store and self.scrape_mode != 'validate':
+            if os.environ.get('MCNA_SESSION_KEY'):
+                self.sessions = SessionStore(session_store, os.environ['MCNA_SESSION_KEY'])
+            else:
+                self.logger.warning('MCNA_SESSION_KEY not set, session store disabled')
+        tmhp_username = self.job_creds['tmhp_username']
+        tmhp_password = self.job_creds['tmhp_password']
         if tmhp_username and not self.scrape_mode == 'validate':
-            self.tmhp = Tmhp(logger=self.logger, jobid=self.creds[0]['jobid'], username=tmhp_username,
+            from .tmhp import Tmhp
+            self.tmhp = Tmhp(logger=self.logger, jobid=self.job_creds['jobid'], username=tmhp_username,
                              password=tmhp_password, mode=scrape_mode)
         else:
             self.tmhp = None
+        # One TMHP check per (subscriber_id, dob) across all MCNA paths and facilities
+        self.tmhp_checks = CheckMemo(tmhp_memo or None, ttl=int(tmhp_memo_ttl))
+        # Sharded run: keep only the accounts, and their partial mode members, that belong to this shard
+        if shard:
+            index, count = parse_shard(shard)
+            self.creds = [c for c in self.creds if shard_of(c['username'], count) == index]
+            self.logger.info('Shard {}/{} crawling {} accounts'.format(index, count, len(self.creds)))
+        # Durable per-job progress, a resumed run skips the rosters and members an earlier run of the job
+        # completed while a fresh run starts the job's progress over
+        self.progress = ProgressStore(progress) if progress and scrape_mode != 'validate' else None
+        self.resume = self.progress is not None and str(resume).lower() in ('1', 'true', 'yes')
+        if self.progress and not self.resume:
+            for c in self.creds:
+                self.progress.clear(c['jobid'], c['username'])
+        # (subscriber_id, dob) -> mid per (username, fid) built from the member cache
+        self.mid_index = dict()
+        self.members_by_user = dict()
         if scrape_mode == 'partial':
-            self.members = json.loads(self.members) if isinstance(self.members, str) else self.members
+            self.members = load_json_arg(self.members)
+            if shard:
+                usernames = set(c['username'] for c in self.creds)
+                self.members = [m for m in self.members if m['username'] in usernames]
             for i, m in enumerate(self.members):
                 self.members[i]['dob'] = convert_date(m['dob'])
+                # Index members by username so each login dispatches only its own members
+                self.members_by_user.setdefault(m['username'], []).append(m)
+
+    @property
+    def renderer(self):
+        if self._renderer is None:
+            self._renderer = AsyncRenderer(client_factory=self.render_client, window=self.render_window)
+        return self._renderer
+
+    # Structured member log line, arguments are only formatted when the level is enabled
+    def log_member(self, level, stage, item, msg, *args):
+        if self.logger.isEnabledFor(level):
+            self.logger.log(level, 'stage=%s user=%s fid=%s mid=%s ' + msg, stage, item.get('username'),
+                            item.get('fid'), item.get('mid'), *args)
 
-    def reset_counter(self):
-        self.counter = 0
+    # Log a truncated body of an unexpected response, capturing the full body when enabled
+    def log_response(self, response, stage):
+        self.logger.error('stage=%s Received response from %s: %s', stage, response.url, BodyPreview(response.text))
+        if self.capture:
+            self.logger.error('stage=%s Full response captured to %s', stage, self.capture.capture(stage, response))
 
+    # Record a completed stage of the job, roster stages are keyed by alpha and member stages by mid
+    def mark_done(self, stage, item, alpha='', data=None):
+        if self.progress:
+            self.progress.mark(stage, item['jobid'], item['username'], item.get('fid', ''), alpha, item.get('mid', ''),
+                               data)
+
+    # True when resuming and an earlier run of the job completed the stage, counted in stats
+    def is_done(self, stage, item, alpha=''):
+        if not self.resume:
+            return False
+        if self.progress.done(stage, item['jobid'], item['username'], item.get('fid', ''), alpha, item.get('mid', '')):
+            self.crawler.stats.inc_value('mcna/resume/skipped/{}'.format(stage))
+            return True
+        return False
+
+    # Re-enqueue the failed request after a backoff delay, or alert once its budget is spent. True when a retry
+    # was scheduled. The waiting retry holds no downloader slot, it only enters the scheduler once the delay is over.
     def repeat_request(self, response, subject, body):
-        time_sleep = (5, 10, 15, 30)
-        self.counter = 0 if self.counter > 4 else self.counter
-        self.counter += 1
-        if self.counter <= 4:
-            time.sleep(time_sleep[self.counter - 1])
-            return response.request.replace(dont_filter=True)
+        request = response.request
+        retries = request.meta.get(self.retry_meta_key, 0) + 1
+        jar = request.meta.get('cookiejar')
+        self.jar_retries[jar] = self.jar_retries.get(jar, 0) + 1
+        callback = getattr(request.callback, '__name__', 'parse')
+        if retries <= self.max_retries and self.jar_retries[jar] <= self.max_jar_retries:
+            self.logger.info('Retrying {} (attempt {}) for cookiejar "{}"'.format(request.url, retries, jar))
+            self.crawler.stats.inc_value('mcna/retry/{}'.format(callback))
+            self.crawler.stats.inc_value('mcna/account/{}/retries'.format(jar))
+            meta = dict(request.meta)
+            meta[self.retry_meta_key] = retries
+            from twisted.internet import reactor
+            d = task.deferLater(reactor, backoff_delay(retries), self.crawler.engine.crawl,
+                                request.replace(meta=meta, dont_filter=True))
+            d.addErrback(lambda failure: failure.trap(defer.CancelledError))
+            d.addBoth(lambda _: self.delayed_retries.discard(d))
+            self.delayed_retries.add(d)
+            return True
         else:
-            send_emails(subject=subject, body=body)
+            self.logger.error('Giving up on {} after {} attempts for cookiejar "{}"'.format(request.url, retries, jar))
+            self.crawler.stats.inc_value('mcna/retry/{}/exhausted'.format(callback))
+            self.alerts.send(subject, body)
+            return False
+
+    # Keep the spider open while retries wait out their backoff
+    def spider_idle(self, spider):
+        if self.delayed_retries:
+            raise DontCloseSpider
+
+    async def closed(self, reason):
+        for d in list(self.delayed_retries):
+            d.cancel()
+        if self.member_cache:
+            self.member_cache.close()
+        if self.response_cache:
+            self.response_cache.close()
+        self.tmhp_checks.close()
+        self.parse_pool.close()
+        if self.progress:
+            self.progress.close()
+        if self.sessions:
+            for username in self.logged_in:
+                self.sessions.put(username, self.session_cookies(username))
+            self.sessions.close()
+        closing = [self.alerts.close()]
+        if self._renderer:
+            closing.append(self._renderer.close())
+        await maybe_deferred_to_future(defer.DeferredList(closing))
 
     def error_handler(self, error):
         self.logger.exception(error)
+        # Error responses are already counted by CrawlMetrics, only count failures that got no response
+        if not error.check(HttpError):
+            self.crawler.stats.inc_value('mcna/account/{}/errors'.format(error.request.meta.get('cookiejar')))
         err = str(error).split('\n')
-        send_emails(subject="MCNA response failed", body="On host {} \n MCNA Spider Error: {}".format(hostname, err[0][1:]))
+        self.alerts.send("MCNA response failed", "On host {} \n MCNA Spider Error: {}".format(hostname, err[0][1:]))
+
+    # Scrapy 2.13+ entry point, older versions call start_requests directly
+    async def start(self):
+        for request in self.start_requests():
+            yield request
 
     # Visit homepage for every user read from file with unique cookiejar for separate session of each user
     def start_requests(self):
@@ -97,38 +441,87 @@ class McnaSpider(scrapy.Spider):
                 item['company'] = user['company']
                 item['practice'] = user['practice'] or user['practice[]']
                 item['facility_id'] = user['facility_id']
-                data = Request(self.base_url, callback=self.parse_homepage, errback=self.error_handler)
-                data.meta['item'] = item
-                data.meta['cookiejar'] = user['username']
-                yield data
+                cookies = self.sessions.get(user['username']) if self.sessions else None
+                if cookies:
+                    # Check the saved session with the roster page before falling back to a full login
+                    data = Request(self.roster_url, cookies=cookies, callback=self.parse_session_check,
+                                   errback=self.session_check_failed, dont_filter=True)
+                    data.meta['item'] = item
+                    data.meta['cookiejar'] = user['username']
+                    yield data
+                else:
+                    yield self.homepage_request(item)
                 if self.tmhp:
                     yield self.tmhp.start_requests()
         except Exception as e:
             msg = 'Error occurred while visit homepage for member with facility ID {} for user "{}", {} company and {}'\
                   ' practice \n Error is: {}'.format(item.get('facility_id'), item.get('username'), item.get('company'),
                                                      item.get('practice'), e)
-            send_emails(subject="MCNA homepage failed", body='On host {} \n {}'.format(hostname, msg))
+            self.alerts.send("MCNA homepage failed", 'On host {} \n {}'.format(hostname, msg))
             self.logger.exception(msg)
 
-    def set_status(self, status, item, one_member=False):
-        if one_member:
-            item['mco_sync_status'] = status
-            item['one_member'] = one_member
+    def homepage_request(self, item):
+        data = Request(self.base_url, callback=self.parse_homepage, errback=self.error_handler, dont_filter=True)
+        data.meta['item'] = item
+        data.meta['cookiejar'] = item['creds']['username']
+        return data
+
+    # Cookies of a user's session as held by the cookies middleware
+    def session_cookies(self, jar):
+        for middleware in self.crawler.engine.downloader.middleware.middlewares:
+            if isinstance(middleware, CookiesMiddleware):
+                return [{'name': c.name, 'value': c.value, 'domain': c.domain, 'path': c.path}
+                        for c in middleware.jars[jar].jar]
+        return []
+
+    # Continue with a saved session when it still reaches the roster page, else log in again
+    async def parse_session_check(self, response):
+        item = response.meta['item'].copy()
+        username = item['creds']['username']
+        if response.url != self.roster_url:
+            self.logger.info('Saved session expired for user "{}", logging in'.format(username))
+            self.sessions.discard(username)
+            yield self.homepage_request(item)
+            return
+        self.logger.info('Reusing saved session for user "{}"'.format(username))
+        self.crawler.stats.inc_value('mcna/session/reused')
+        self.logged_in.add(username)
+        yield self.set_status('Pending', item)
+        item['username'] = username
+        item.pop('creds', None)
+        if self.scrape_mode == 'all':
+            # The check already fetched the roster page, parse it as if requested after login
+            response.meta['item'] = item
+            async for result in self.parse_facility_id(response):
+                yield result
         else:
-            item['mco_sync_status'] = status
-            item['members'] = self.members
-        return item
+            for result in self.member_requests(item, response.meta['cookiejar']):
+                yield result
+
+    def session_check_failed(self, failure):
+        item = failure.request.meta['item']
+        self.logger.info('Saved session check failed for user "{}", logging in'.format(item['creds']['username']))
+        return self.homepage_request(item)
+
+    def set_status(self, status, item, one_member=False):
+        return StatusEvent(status, item, one_member)
+
+    # Input members a status event applies to, all of them unless in partial mode
+    def resolve_members(self, event):
+        if self.scrape_mode == 'partial':
+            return self.members_by_user.get(event.get('username'), [])
+        return self.members
 
     # Get login form token from homepage
     def parse_homepage(self, response):
         try:
             item = response.meta['item'].copy()
             yield self.set_status('Pending', item)
-            auth_token = re.search(r'AUTH_TOKEN = "(.*)";', response.text)
+            auth_token = mcna_parsers.parse_auth_token(response.text)
             if auth_token:
                 fdata = {'username': item['creds']['username'],
                          'password': item['creds']['password'],
-                         'authenticity_token': auth_token.group(1)}
+                         'authenticity_token': auth_token}
                 data = FormRequest(self.login_url, formdata=fdata, callback=self.parse_login, errback=self.error_handler)
                 data.meta['item'] = item
                 data.meta['cookiejar'] = response.meta['cookiejar']
@@ -144,13 +537,13 @@ class McnaSpider(scrapy.Spider):
             msg = 'Error occurred while get login form token from homepage for member with {} facility ID for {} user' \
                   ', {} company and {} practice \n Error is: {}'.format(
                 item.get('facility_id'), item.get('username'), item.get('company'), item.get('practice'), e)
-            send_emails(subject="MCNA parse home page failed", body='On host {} \n {}'.format(hostname, msg))
+            self.alerts.send("MCNA parse home page failed", 'On host {} \n {}'.format(hostname, msg))
             self.logger.exception(msg)
 
     # Verify login successful and proceed to fetch facility ids
     def parse_login(self, response):
+        item = response.meta['item'].copy()
         try:
-            item = response.meta['item'].copy()
             item['username'] = item['creds']['username']
             # Remove creds from the item as not required in later requests
             item.pop('creds', None)
@@ -162,7 +555,7 @@ class McnaSpider(scrapy.Spider):
                 msg = 'Authentication failed for user "{}". Error captured: {}'.format(
                     item['username'], login_reponse.get('portal_user_authenticate').get('response_message'))
                 self.logger.error(msg)
-                send_emails(subject="MCNA authentication failed", body='On host {} \n {}'.format(hostname, msg))
+                self.alerts.send("MCNA authentication failed", 'On host {} \n {}'.format(hostname, msg))
                 if self.scrape_mode == 'validate':
                     self.logger.info('Validation Failed')
                     item['result'] = 'Invalid'
@@ -170,68 +563,83 @@ class McnaSpider(scrapy.Spider):
             else:
                 msg = 'Login successful for user "{}"'.format(item['username'])
                 self.logger.info(msg)
+                self.logged_in.add(item['username'])
                 # If scraping all then parse facility ids else start getting eligibility info for members
                 if self.scrape_mode in ['all', 'validate']:
                     data = Request(self.roster_url, callback=self.parse_facility_id, errback=self.error_handler)
                     data.meta['item'] = item
                     data.meta['cookiejar'] = response.meta['cookiejar']
-                    self.reset_counter()
                     yield data
                 else:
-                    for member in self.members:
-                        # Read only members specified for the current logged in user
-                        if member['username'] == item['username']:
-                            member['practice'] = item['practice']
-                            item = member
-                            # Save input dob for later use in output
-                            item['dob'] = item['Member Date of Birth'] if 'dob' not in item.keys() else item['dob']
-                            # Manage cli or web ui input for date of birth field
-                            month, day, year = item['Member Date of Birth'].split('/') if 'dob' not in item.keys() else \
-                                item[
-                                    'dob'].split('/')
-                            dob_formatted = "-".join([year, month, day])
-                            # Proceed only if valid mid is present in the input data
-                            if item['mid'] != '':
-                                url = self.member_eligibility_url.format(item['mid'], item['subscriber_id'],
-                                                                         dob_formatted,
-                                                                         item['fid'])
-
-                                msg = 'Requesting eligibility info for member with mid {} and facility ID {} for user "{}"'.format(
-                                    item['mid'], item['fid'], item['username'])
-                                self.logger.info(msg)
-                                data = Request(url, callback=self.parse_member_eligibility, errback=self.error_handler,
-                                               headers={'Referer': 'https://portal.mcna.net/provider/verify_eligibility'})
-                                data.meta['item'] = item
-                                data.meta['cookiejar'] = response.meta['cookiejar']
-                                self.reset_counter()
-                                yield data
-                            else:
-                                query = {'verifyDob': item['dob'],
-                                         'verifySubscriberId': item['subscriber_id'],
-                                         'verifyLastName': '',
-                                         'verifyFirstName': '',
-                                         'verifyZip': '',
-                                         'providerFacilityId': item['fid']}
-                                url = build_url(self.verify_eligibility_url, query)
-                                msg = 'Requesting verify eligibility page for member with subscriber id {} and facility ID {} for user "{}"'.format(
-                                    item['subscriber_id'], item['fid'], item['username'])
-                                self.logger.info(msg)
-                                data = Request(url, callback=self.parse_verify_eligibility, errback=self.error_handler,
-                                               headers={'X-Requested-With': 'XMLHttpRequest',
-                                                        'Referer': 'https://portal.mcna.net/provider/verify_eligibility'})
-                                data.meta['item'] = item
-                                data.meta['cookiejar'] = response.meta['cookiejar']
-                                self.reset_counter()
-                                yield data
-                                pass
+                    for data in self.member_requests(item, response.meta['cookiejar']):
+                        yield data
         except Exception as e:
-            yield self.set_status('Outdated', item)
             msg = 'Error occurred while Verify login successful and proceed to fetch facility ids for member with ' \
                   'facility ID {} for user "{}", {} company and {} practice \n Error is: {}'.format(
                 item.get('facility_id'), item.get('username'), item.get('company'), item.get('practice'), e)
             self.logger.exception(msg)
-            yield self.repeat_request(response, "MCNA parse login failed",
-                                      'On host {} \n {}'.format(hostname, msg))
+            # Only mark the user outdated once the retry budget is spent
+            if not self.repeat_request(response, "MCNA parse login failed", 'On host {} \n {}'.format(hostname, msg)):
+                yield self.set_status('Outdated', item)
+
+    # Lazily build the eligibility requests for the partial mode members of the logged in user. Members without
+    # mid get it from the member cache, only the rest go through verify eligibility first. The roster can't
+    # resolve them, its records carry no subscriber id or dob.
+    def member_requests(self, user_item, cookiejar):
+        for member in self.members_by_user.get(user_item['username'], []):
+            item = MemberRecord(member, practice=user_item['practice'])
+            # Save input dob for later use in output, managing cli or web ui input for date of birth field
+            item['dob'] = item['Member Date of Birth'] if 'dob' not in item else item['dob']
+            if item['mid'] == '':
+                item['mid'] = self.cached_mid(item)
+                if item['mid']:
+                    self.crawler.stats.inc_value('mcna/mid_resolver/cache')
+            # Proceed only if valid mid is present in the input data
+            if item['mid'] != '' and self.is_done('eligibility', item):
+                continue
+            if item['mid'] != '':
+                yield self.eligibility_request(item, cookiejar)
+            else:
+                self.crawler.stats.inc_value('mcna/mid_resolver/verify')
+                yield self.verify_request(item, cookiejar)
+
+    # Mid of a member from the member cache of earlier all mode syncs, '' when unknown. Both subscriber id and dob
+    # have to match, a mistyped dob still goes through verify eligibility and its alert.
+    def cached_mid(self, item):
+        if not self.member_cache:
+            return ''
+        key = (item['username'], item['fid'])
+        if key not in self.mid_index:
+            self.mid_index[key] = self.member_cache.mids(*key)
+        return self.mid_index[key].get((str(item['subscriber_id']), item['dob']), '')
+
+    def eligibility_request(self, item, cookiejar):
+        month, day, year = item['dob'].split('/')
+        dob_formatted = "-".join([year, month, day])
+        url = self.member_eligibility_url.format(item['mid'], item['subscriber_id'], dob_formatted, item['fid'])
+        self.log_member(logging.INFO, 'eligibility', item, 'Requesting eligibility info')
+        data = Request(url, callback=self.parse_member_eligibility, errback=self.error_handler,
+                       headers={'Referer': 'https://portal.mcna.net/provider/verify_eligibility'})
+        data.meta['item'] = item
+        data.meta['cookiejar'] = cookiejar
+        return data
+
+    def verify_request(self, item, cookiejar):
+        query = {'verifyDob': item['dob'],
+                 'verifySubscriberId': item['subscriber_id'],
+                 'verifyLastName': '',
+                 'verifyFirstName': '',
+                 'verifyZip': '',
+                 'providerFacilityId': item['fid']}
+        url = build_url(self.verify_eligibility_url, query)
+        self.log_member(logging.INFO, 'verify_eligibility', item,
+                        'Requesting verify eligibility page for subscriber id %s', item['subscriber_id'])
+        data = Request(url, callback=self.parse_verify_eligibility, errback=self.error_handler,
+                       headers={'X-Requested-With': 'XMLHttpRequest',
+                                'Referer': 'https://portal.mcna.net/provider/verify_eligibility'})
+        data.meta['item'] = item
+        data.meta['cookiejar'] = cookiejar
+        return data
 
     def parse_verify_eligibility(self, response):
         item = response.meta['item'].copy()
@@ -241,23 +649,15 @@ class McnaSpider(scrapy.Spider):
             # if response message is OK then add mid and formatted dob to item and proceed to eligibility page
             if eligbility['response_message'] == 'OK':
                 item['mid'] = eligbility['insured']['id']
-                month, day, year = item['Member Date of Birth'].split('/') if 'dob' not in item.keys() else item[
-                    'dob'].split('/')
-                dob_formatted = "-".join([year, month, day])
-                url = self.member_eligibility_url.format(item['mid'], item['subscriber_id'], dob_formatted, item['fid'])
-                msg = 'Requesting eligibility info for member with mid {} and facility ID {} for user "{}"'.format(
-                    item['mid'], item['fid'], item['username'])
-                self.logger.info(msg)
-                data = Request(url, callback=self.parse_member_eligibility, errback=self.error_handler)
-                data.meta['item'] = item
-                data.meta['cookiejar'] = response.meta['cookiejar']
-                yield data
+                if self.is_done('eligibility', item):
+                    return
+                yield self.eligibility_request(item, response.meta['cookiejar'])
             else:
                 msg = 'Error occurred while parsing verify eligibility data for member with subscriber id {} and ' \
                       'facility ID {} for user "{}"'.format(item['subscriber_id'], item['fid'], item['username'])
                 self.logger.error(msg)
-                send_emails(subject="MCNA parse verify eligibility failed", body='On host {} \n {}'.format(hostname, msg))
-                self.logger.error('Received response: {}'.format(response.text))
+                self.alerts.send("MCNA parse verify eligibility failed", 'On host {} \n {}'.format(hostname, msg))
+                self.log_response(response, 'verify_eligibility')
         except Exception as e:
             yield self.set_status('Outdated', item)
             msg = 'Error occurred while parsing verify eligibility data for member with subscriber id {} and facility' \
@@ -265,25 +665,49 @@ class McnaSpider(scrapy.Spider):
                 item.get('facility_id'), item.get('username'), item.get('company'), item.get('practice'), e)
             self.logger.exception(msg)
             self.logger.exception(e)
-            send_emails(subject="MCNA parse verify eligibility failed", body='On host {} \n {}'.format(hostname, msg))
-            self.logger.error('Received response: {}'.format(response.text))
+            self.alerts.send("MCNA parse verify eligibility failed", 'On host {} \n {}'.format(hostname, msg))
+            self.log_response(response, 'verify_eligibility')
 
     # Parse facility/facilities user is assigned to and get member list for each
-    def parse_facility_id(self, response):
+    async def parse_facility_id(self, response):
+        facilities = None
+        if response.url == self.roster_url:
+            try:
+                facilities = await self.parse_page(response, mcna_parsers.parse_facility_ids)
+            except Exception:
+                facilities = Failure()
+        for result in self.facility_ids_parsed(facilities, response):
+            yield result
+
+    # Parse the response body in the parse pool. The time spent awaiting it is left out of the callback timer
+    # through meta['callback_waited'], the parse itself is recorded by record_parse_time.
+    async def parse_page(self, response, parser):
+        wall_start, cpu_start = time.perf_counter(), time.thread_time()
+        try:
+            return await maybe_deferred_to_future(
+                self.parse_pool.run(parser, response.text, callback_name(response.request)))
+        finally:
+            waited = response.meta.setdefault('callback_waited', [0.0, 0.0])
+            waited[0] += time.perf_counter() - wall_start
+            waited[1] += time.thread_time() - cpu_start
+
+    # Parse time of pages handed to the parse pool counts towards the callback that handed them off
+    def record_parse_time(self, name, wall, cpu):
+        record_callback_time(self.crawler.stats, name, wall, cpu)
+
+    def facility_ids_parsed(self, facilities, response):
+        item = response.meta['item'].copy()
         # Verify the response url before proceeding
         self.logger.debug(response.url)
         if response.url != self.roster_url:
-            item = response.meta['item'].copy()
             yield self.set_status('Outdated', item)
             # Something went wrong with login page , authentication failure or some unexpected page
             msg = 'Unexpected page received, manually login and check for any unexpected redirects after login for ' \
                   'member with subscriber id {} and facility ID {} for user "{}", {} company and {} practice'.format(
                 item.get('subscriber_id'), item.get('facility_id'), item.get('username'), item.get('company'), item.get('practice'))
             self.logger.error(msg)
-            send_emails(subject="MCNA parse facility id failed", body='On host {} \n {}'.format(hostname, msg))
-            self.logger.error('Received following page:')
-            self.logger.error(response.url)
-            self.logger.error('Received response: {}'.format(response.text))
+            self.alerts.send("MCNA parse facility id failed", 'On host {} \n {}'.format(hostname, msg))
+            self.log_response(response, 'facility_id')
             if self.scrape_mode == 'validate':
                 item = response.meta['item'].copy()
                 self.logger.info('Validation Failed')
@@ -291,35 +715,13 @@ class McnaSpider(scrapy.Spider):
                 yield item
         else:
             try:
-                # Parse the html page
-                soup = bs(response.text, 'html.parser')
-                # Find input element with id=facilityId in the page
-                fid = soup.find('input', id='facilityId')
-                # If non blank facility id found save it in list
-                fid_list = []
-                # Create a dictionary if in validate mode
+                if isinstance(facilities, Failure):
+                    facilities.raiseException()
+                # Map facility ids to names in validate mode, else just list them
                 if self.scrape_mode == 'validate':
-                    fid_list = dict()
-                if fid and fid['value'] != "":
-                    if self.scrape_mode == 'validate':
-                        fid_list[fid['value']] = ''
-                    else:
-                        fid_list.append(fid['value'])
-                # Else search for facility ID selection box in case of multiple facility assigned for user
-                # For some unknown reason BS failing to parse the option of select element hence using a div containing it
+                    fid_list = dict(facilities)
                 else:
-                    facilities_selection = soup.find('div', id='headerText')
-                    # Get all member provider IDS
-                    facilities = facilities_selection.find_all('option')
-                    if facilities:
-                        # Store member provider ids in list if not 0 which is 'Select a Facility'
-                        for f in facilities:
-                            if f['value'] != "0":
-                                if self.scrape_mode == 'validate':
-                                    fid_list[f['value']] = f.text
-                                else:
-                                    fid_list.append(f['value'])
-                                    # Validate mode
+                    fid_list = [fid for fid, _ in facilities]
                 if self.scrape_mode == 'validate':
                     item = response.meta['item'].copy()
                     self.logger.info('Validation Successful')
@@ -338,24 +740,13 @@ class McnaSpider(scrapy.Spider):
                             item['result'] = 'Invalid'
                             yield item
                     else:
-                        self.logger.debug(fid_list)
+                        self.logger.debug('Facility IDs for user "%s": %s', item['username'], fid_list)
                         item = response.meta['item'].copy()
                         # Check if provided facility id at start is valid for this user
                         if item['facility_id'] in fid_list:
                             # We are good to go with the provided facility id
                             item['fid'] = item['facility_id']
-                            for i in range(ord('a'), ord('z') + 1):
-                                query = {'alpha': chr(i), 'providerFacilityId': item['fid']}
-                                url = build_url(self.members_url, query)
-                                msg = 'Fetching members for alphabet {} with facility ID {} for user "{}"'. \
-                                    format(chr(i), item['fid'], item['username'])
-                                self.logger.debug(msg)
-                                # Update headers to mimic the data is requested by ajax call
-                                data = Request(url, callback=self.parse_members, errback=self.error_handler,
-                                               headers={'X-Requested-With': 'XMLHttpRequest'})
-                                data.meta['item'] = item
-                                data.meta['cookiejar'] = response.meta['cookiejar']
-                                self.reset_counter()
+                            for data in self.roster_requests(item, response.meta['cookiejar']):
                                 yield data
                         else:
                             # Else log error and stop crawling process
@@ -371,196 +762,244 @@ class McnaSpider(scrapy.Spider):
                 msg = 'Error occurred while parsing for member with subscriber id {} and facility ID {} for user "{}"' \
                       ', {} company and {} practice \n Error is: {}'.format(item.get('subscriber_id'),
                 item.get('facility_id'), item.get('username'), item.get('company'), item.get('practice'), e)
-                send_emails(subject="MCNA parse facility id failed", body='On host {} \n {}'.format(hostname, msg))
+                self.alerts.send("MCNA parse facility id failed", 'On host {} \n {}'.format(hostname, msg))
                 self.logger.exception(msg)
-                self.logger.error('Received response: {}'.format(response.text))
+                self.log_response(response, 'facility_id')
                 if self.scrape_mode == 'validate':
                     self.logger.info('Validation Failed')
                     item['result'] = 'Invalid'
                     yield item
 
+    # Roster requests for the facility. A resumed run replays the rosters it already fetched and only requests
+    # the letters still missing.
+    def roster_requests(self, item, cookiejar):
+        rosters = self.progress.rosters(item['jobid'], item['username'], item['fid']) if self.resume else dict()
+        if '' in rosters:
+            rosters = {'': rosters['']}
+        elif rosters or self.roster_mode != 'probe':
+            for letter in roster_letters:
+                if letter not in rosters:
+                    yield self.roster_request(item, cookiejar, letter, self.parse_members)
+        else:
+            # Try the whole roster in one request, per alphabet only if it comes back truncated
+            yield self.roster_request(item, cookiejar, '', self.parse_roster_probe)
+        for alpha, members in rosters.items():
+            self.log_member(logging.INFO, 'roster', item, 'Resuming %s members of alphabet "%s" from saved roster',
+                            len(members), alpha)
+            self.crawler.stats.inc_value('mcna/resume/skipped/roster')
+            for data in self.member_info_requests(item, cookiejar, members):
+                yield data
+
+    def roster_request(self, item, cookiejar, alpha, callback):
+        query = {'alpha': alpha, 'providerFacilityId': item['fid']}
+        url = build_url(self.members_url, query)
+        self.log_member(logging.DEBUG, 'roster', item, 'Fetching members for alphabet "%s"', alpha)
+        # Update headers to mimic the data is requested by ajax call
+        data = Request(url, callback=callback, errback=self.error_handler,
+                       headers={'X-Requested-With': 'XMLHttpRequest'})
+        data.meta['item'] = item
+        data.meta['cookiejar'] = cookiejar
+        return data
+
+    # Use the unfiltered roster when it is complete, else fall back to one request per alphabet
+    def parse_roster_probe(self, response):
+        item = response.meta['item']
+        try:
+            num_recs, members = mcna_parsers.parse_roster(response.text)
+            complete = 0 < num_recs == len(members) < int(self.roster_page_limit)
+        except Exception as e:
+            self.logger.warning('Roster probe failed for facility ID {} for user "{}": {}'.format(
+                item['fid'], item['username'], e))
+            complete = False
+        if complete:
+            self.logger.info('Members data received for {} members with facility ID {} for user "{}"'.format(
+                num_recs, item['fid'], item['username']))
+            self.mark_done('roster', item, data=members)
+            for data in self.member_info_requests(item, response.meta['cookiejar'], members):
+                yield data
+        else:
+            for letter in roster_letters:
+                yield self.roster_request(item, response.meta['cookiejar'], letter, self.parse_members)
+
     # Parse members list received for each alphabet with specified facility ID and get additional info per member
     def parse_members(self, response):
-        memberdata = json.loads(response.text)
-        # Append member records for current alphabet to main list and print log if no records
-        self.logger.debug(memberdata)
-        members = []
+        item = response.meta['item']
         try:
-            # If single record received then it's dictionary so append
-            num_recs = memberdata['members_roster_list']["num_recs"]
-            o = urlparse(response.url)
-            query = parse_qs(o.query)
-            if num_recs == "1":
-                records = memberdata['members_roster_list']['members']
+            _, members = mcna_parsers.parse_roster(response.text)
+            self.logger.debug('Roster records: %s', members)
+            query = parse_qs(urlparse(response.url).query)
+            if members:
                 msg = 'Members data received for alphabet {} with facility ID {} for user "{}"'.format(
                     query['alpha'], response.meta['item']['fid'], response.meta['item']['username'])
-                members.append(records)
-                self.logger.info(msg)
             # If no records just notify
-            elif num_recs == "0":
-                msg = 'No members data received for alphabet {} with facility ID {} for user "{}"'.format(
-                    query['alpha'], response.meta['item']['fid'], response.meta['item']['username'])
-                self.logger.info(msg)
-            # else it's list so concatenate
             else:
-                records = memberdata['members_roster_list']['members']
-                members += (records)
-                msg = 'Members data received for alphabet {} with facility ID {} for user "{}"'.format(
+                msg = 'No members data received for alphabet {} with facility ID {} for user "{}"'.format(
                     query['alpha'], response.meta['item']['fid'], response.meta['item']['username'])
-                self.logger.info(msg)
-            # Store member data and request for additional details
-            for member in members:
-                item = response.meta['item'].copy()
-                # Get additional details of the member
-                item['fname'] = member['fname']
-                item['lname'] = member['lname']
-                item['city'] = member['city']
-                item['mid'] = member['id']
-                if self.scrape_mode == 'validate':
-                    item['patient_uuid'] = member['patient_uuid']
-                item['dentist'] = '{}, {} {}'.format(member['prov_lname'], member['prov_fname'], member['prov_title'])
-                query = {'id': member['id'], 'providerFacilityId': item['fid']}
-                url = build_url(self.member_info_url, query)
-                data = Request(url, callback=self.parse_member_info, headers={'X-Requested-With': 'XMLHttpRequest'},
-                               errback=self.error_handler)
-                data.meta['item'] = item
-                data.meta['cookiejar'] = response.meta['cookiejar']
-                self.reset_counter()
+            self.logger.info(msg)
+            self.mark_done('roster', item, alpha=query['alpha'][0], data=members)
+            for data in self.member_info_requests(item, response.meta['cookiejar'], members):
                 yield data
         except Exception as e:
             msg = 'Error occurred while parsing members data for member with subscriber id {} and facility' \
                   ' ID {} for user "{}", {} company and {} practice \n Error is: {}'.format(item.get('subscriber_id'),
                 item.get('facility_id'), item.get('username'), item.get('company'), item.get('practice'), e)
             self.logger.exception(msg)
-            yield self.repeat_request(response, "MCNA parse members failed",
-                                      'Received response: {}'.format(response.text))
+            self.repeat_request(response, "MCNA parse members failed",
+                                'Received response: {}'.format(BodyPreview(response.text)))
+
+    # Store member data and request for additional details
+    def member_info_requests(self, roster_item, cookiejar, members):
+        for member in members:
+            item = MemberRecord(roster_item)
+            # Get additional details of the member
+            item['fname'] = member['fname']
+            item['lname'] = member['lname']
+            item['city'] = member['city']
+            item['mid'] = member['id']
+            if self.scrape_mode == 'validate':
+                item['patient_uuid'] = member['patient_uuid']
+            item['dentist'] = '{}, {} {}'.format(member['prov_lname'], member['prov_fname'], member['prov_title'])
+            if self.is_done('member', item):
+                continue
+            info = self.member_cache.get(item) if self.member_cache and not item.get('new_patient') else None
+            if info:
+                self.log_member(logging.DEBUG, 'member_info', item, 'Member info served from cache')
+                self.crawler.stats.inc_value('mcna/member_cache/hit')
+                item.update(info)
+                for result in self.member_synced(item):
+                    yield result
+                continue
+            query = {'id': member['id'], 'providerFacilityId': item['fid']}
+            url = build_url(self.member_info_url, query)
+            data = Request(url, callback=self.parse_member_info, headers={'X-Requested-With': 'XMLHttpRequest'},
+                           errback=self.error_handler)
+            data.meta['item'] = item
+            data.meta['cookiejar'] = cookiejar
+            yield data
 
     # Parse additional info for member and save to file
     def parse_member_info(self, response):
+        item = response.meta['item'].copy()
         try:
-            info = json.loads(response.text)['get_member_info']
-            item = response.meta['item'].copy()
-            msg = 'Parsing additional info for member {} {} with facility ID {} for user "{}"' \
-                .format(item['lname'], item['fname'], item['fid'], item['username'])
-            self.logger.info(msg)
-            item['address'] = '{} {}'.format(info['address1'], info['csz'])
-            item['dob'] = info['dob']
-            item['telephone'] = info['telephone']
-            item['subscriber_id'] = info['subscriber_id']
+            info = mcna_parsers.parse_member_info(response.text)
+            self.log_member(logging.INFO, 'member_info', item, 'Parsing additional info for member %s %s',
+                            item['lname'], item['fname'])
+            item.update(info)
+            if self.member_cache:
+                self.member_cache.put(item, info)
 
             if self.scrape_mode == 'all':
-                item['mco_sync_status'] = 'Updated (no PDF)'
-                item['mco_status'] = True
-                if self.tmhp:
-                    yield self.tmhp.check_eligibility(item['subscriber_id'], item['dob'], item['fname'], item['lname'],
-                                                      item.get('company'), item.get('practice'), self.name)
-                yield item
+                for result in self.member_synced(item):
+                    yield result
 
             if self.scrape_mode == 'partial' or item.get('new_patient'):
-                # Prepare data for fetching member eligibility info
-                month, day, year = item['dob'].split('/')
-                dob_formatted = "-".join([year, month, day])
-                url = self.member_eligibility_url.format(item['mid'], item['subscriber_id'], dob_formatted, item['fid'])
-
-                msg = 'Requesting eligibility info for member {} {} with facility ID {} for user "{}"' \
-                    .format(item['lname'], item['fname'], item['fid'], item['username'])
-                self.logger.info(msg)
-                data = Request(url, callback=self.parse_member_eligibility, errback=self.error_handler)
-                data.meta['item'] = item
-                data.meta['cookiejar'] = response.meta['cookiejar']
-                self.reset_counter()
-                yield data
+                yield self.eligibility_request(item, response.meta['cookiejar'])
         except Exception as e:
             msg = 'Error occurred while parsing the additional info for member {} {} with facility ID {} for ' \
                   'user "{}", {} company and {} practice'.format(
                 item['lname'], item['fname'], item['fid'], item['username'], item.get('company'), item.get('practice'))
             self.logger.exception(msg)
             self.logger.exception(e)
-            yield self.repeat_request(response, "MCNA parse member failed",
-                                      'Received response: {}'.format(response.text))
+            self.repeat_request(response, "MCNA parse member failed",
+                                'Received response: {}'.format(BodyPreview(response.text)))
 
-    def parse_member_eligibility(self, response):
-        item = response.meta['item'].copy()
+    # Emit the roster sync result for a member whose info is known
+    def member_synced(self, item):
+        item['mco_sync_status'] = 'Updated (no PDF)'
+        item['mco_status'] = True
+        check = self.check_tmhp(item)
+        if check:
+            yield check
+        self.mark_done('member', item)
+        yield dict(item)
+
+    # TMHP eligibility check for the member, None when it was already checked or is in flight. A duplicate arriving
+    # while the first check is in flight waits on it, and takes over the check if it fails.
+    def check_tmhp(self, item):
+        if not self.tmhp:
+            return None
+        if not self.tmhp_checks.first(item['subscriber_id'], item['dob'], waiter=item):
+            self.crawler.stats.inc_value('mcna/tmhp/deduplicated')
+            return None
+        return self.tmhp_request(item)
+
+    # The Tmhp check request, with its callbacks wrapped so the memo learns whether the check went through
+    def tmhp_request(self, item):
+        request = self.tmhp.check_eligibility(item['subscriber_id'], item['dob'], item['fname'], item['lname'],
+                                              item.get('company'), item.get('practice'), self.name)
+        meta = dict(request.meta, tmhp_check=(item['subscriber_id'], item['dob']),
+                    tmhp_handlers=(request.callback, request.errback))
+        return request.replace(callback=self.tmhp_checked, errback=self.tmhp_check_failed, meta=meta)
+
+    def tmhp_checked(self, response):
+        callback, _ = response.meta['tmhp_handlers']
         try:
-            if self.scrape_mode == 'all':
-                msg = 'Parsing eligibility info for member {} {} with facility ID {} for user "{}"' \
-                    .format(item['lname'], item['fname'], item['fid'], item['username'])
-            else:
-                msg = 'Parsing eligibility info for member with mid {} and facility ID {} for user "{}"' \
-                    .format(item['mid'], item['fid'], item['username'])
-            self.logger.info(msg)
-            data = response.text
-            soup = bs(data, 'lxml')
-            plan = re.search(r'<div class="eligLabel">Plan:</div>(.*)</div>', data)
-            item['mco_sync_status'] = 'Updated'
-            if plan:
-                item['plan'] = plan.group(1)
-            else:
-                item['plan'] = ''
-
-            eg_date = re.search(r'This member is on the .* plan and became eligible for benefits on (\d+/\d+/\d+).',
-                                data)
-            active = 'active' in re.search(r'This member is currently .*', data).group(0)
-            eligible = 'eligible' in re.search(r'Subscriber is .*', data).group(0)[:-5].lower()
-            self.logger.info('active is: {} and eligible is {} for item: {}'.format(active, eligible, item))
-            if active and eligible:
-                item['mco_status'] = True
-            else:
-                item['mco_status'] = False
+            for result in arg_to_iter(callback(response)):
+                yield result
+        except Exception as e:
+            self.logger.exception(e)
+            for result in self.tmhp_retry(response.meta):
+                yield result
+            return
+        self.tmhp_checks.succeeded(*response.meta['tmhp_check'])
 
-            if eg_date:
-                item['became_eligible_on'] = eg_date.group(1)
-            else:
-                item['became_eligible_on'] = ''
+    def tmhp_check_failed(self, failure):
+        _, errback = failure.request.meta['tmhp_handlers']
+        if errback:
+            results = list(arg_to_iter(errback(failure)))
+        else:
+            self.logger.error('TMHP check failed: %s', failure)
+            results = []
+        return results + list(self.tmhp_retry(failure.request.meta))
 
-            confirmation_no = re.search(r'Confirmation: (#\d+)<br/>', data)
-            if confirmation_no:
-                item['confirmation_no'] = confirmation_no.group(1)
-            else:
-                item['confirmation_no'] = ''
+    # Hand a failed check to the next duplicate waiting on it
+    def tmhp_retry(self, meta):
+        waiter = self.tmhp_checks.failed(*meta['tmhp_check'])
+        if waiter is not None:
+            self.crawler.stats.inc_value('mcna/tmhp/retried')
+            yield self.tmhp_request(waiter)
 
-            services_table = soup.find_all('table', class_='services')[-1]
-            service_date = services_table.find('td')
-            if service_date:
-                item['last_service_date'] = service_date.text
-            else:
-                item['last_service_date'] = ''
-
-            last_prophylaxis_date = ''
-            rows = []
-            prophylaxis_child = soup.find('td', title='PROPHYLAXIS - CHILD')
-            prophylaxis_adult = soup.find('td', title='PROPHYLAXIS - ADULT')
-
-            # First check if adult prophy present as data is ordered chronologically in the html page
-            if prophylaxis_adult:
-                rows = prophylaxis_adult.findAllPrevious('tr')
-            elif prophylaxis_child:
-                rows = prophylaxis_child.findAllPrevious('tr')
-            for row in rows:
-                if row.find('td'):
-                    if row.td.text != '':
-                        last_prophylaxis_date = row.td.text
-                        break
-            item['last_prophylaxis_date'] = last_prophylaxis_date
+    async def parse_member_eligibility(self, response):
+        try:
+            eligibility = await self.parse_page(response, mcna_parsers.parse_eligibility_page)
+        except Exception:
+            eligibility = Failure()
+        for result in self.member_eligibility_parsed(eligibility, response):
+            yield result
+
+    def member_eligibility_parsed(self, eligibility, response):
+        item = response.meta['item'].copy()
+        try:
+            self.log_member(logging.INFO, 'eligibility', item, 'Parsing eligibility info')
+            if isinstance(eligibility, Failure):
+                eligibility.raiseException()
+            item['mco_sync_status'] = 'Updated'
+            item['plan'] = eligibility['plan']
+            # Member status lines missing from the page, nothing more to extract
+            if eligibility['active'] is None:
+                self.mark_done('eligibility', item)
+                yield dict(item)
+                return
+            active, eligible = eligibility['active'], eligibility['eligible']
+            self.log_member(logging.INFO, 'eligibility', item, 'active is: %s and eligible is %s', active, eligible)
+            self.logger.debug('Eligibility item: %s', item)
+            item['mco_status'] = active and eligible
+            for field in ('became_eligible_on', 'confirmation_no', 'last_service_date', 'last_prophylaxis_date'):
+                item[field] = eligibility[field]
             # Check if we have eligibility confirmation link in the page and if yes go to that link
-            print_eligibility_link = soup.find('a', text='Print Eligibility Confirmation')
+            print_eligibility_link = eligibility['print_link']
             if print_eligibility_link:
-                url = self.base_url + print_eligibility_link['href']
-                if self.scrape_mode == 'all':
-                    msg = 'Requesting print eligibility info for member {} {} with facility ID {} for user "{}"' \
-                        .format(item['lname'], item['fname'], item['fid'], item['username'])
-                else:
-                    msg = 'Requesting print eligibility info for member with mid {} and facility ID {} for user "{}"' \
-                        .format(item['mid'], item['fid'], item['username'])
-                self.logger.info(msg)
+                url = self.base_url + print_eligibility_link
+                self.log_member(logging.INFO, 'print_eligibility', item, 'Requesting print eligibility info')
                 data = Request(url, callback=self.parse_print_eligibility, errback=self.error_handler)
                 data.meta['item'] = item
                 data.meta['cookiejar'] = response.meta['cookiejar']
-                self.reset_counter()
                 yield data
-            yield item
+            self.mark_done('eligibility', item)
+            yield dict(item)
         except AttributeError:
-            yield item
+            self.mark_done('eligibility', item)
+            yield dict(item)
         except Exception as e:
             if self.scrape_mode == 'all':
                 msg = 'Error occurred while parsing eligibility info for member {} {} with facility ID {} for user {}' \
@@ -572,29 +1011,27 @@ class McnaSpider(scrapy.Spider):
                     item['mid'], item['fid'], item['username'], item.get('company'), item.get('practice'))
             self.logger.exception(msg)
             self.logger.exception(e)
-            yield self.repeat_request(response, "MCNA parse member eligibility failed",
-                                      'On host {} \n {}'.format(hostname, msg))
+            self.repeat_request(response, "MCNA parse member eligibility failed",
+                                'On host {} \n {}'.format(hostname, msg))
+
+    async def parse_print_eligibility(self, response):
+        # In partial scraping mode the patient's name comes from the print eligibility page
+        subscriber_name = None
+        if self.scrape_mode == 'partial':
+            subscriber_name = await self.parse_page(response, mcna_parsers.parse_subscriber_name)
+        for result in self.print_eligibility_parsed(subscriber_name, response):
+            yield result
 
-    def parse_print_eligibility(self, response):
+    def print_eligibility_parsed(self, subscriber_name, response):
         item = response.meta['item'].copy()
-        if 'practice' in self.creds[0]:
-            item['practice'] = self.creds[0].get('practice')
+        if 'practice' in self.job_creds:
+            item['practice'] = self.job_creds.get('practice')
         item.pop('new_patient') if item.get('new_patient') else None
 
-        if self.scrape_mode == 'all':
-            msg = 'Rendering print eligibility info for member {} {} with facility ID {} for user "{}"' \
-                .format(item['lname'], item['fname'], item['fid'], item['username'])
-        else:
-            msg = 'Rendering print eligibility info for member with mid {} and facility ID {} for user "{}"' \
-                .format(item['mid'], item['fid'], item['username'])
-        self.logger.info(msg)
+        self.log_member(logging.INFO, 'print_eligibility', item, 'Rendering print eligibility info')
 
-        # If in partial scraping mode find patients name from the eligibility page data
-        if self.scrape_mode == 'partial':
-            soup = bs(response.text, 'lxml')
-            item['fname'], item['lname'] = \
-                soup.find('div', class_='infoLabel', text=("Subscriber's Name:")).parent.text.split(':')[
-                    -1].strip().split(" ", 1)
+        if subscriber_name:
+            item['fname'], item['lname'] = subscriber_name
 
         filename = '{} {}_{}_{}{}'.format(item['lname'], item['fname'], 'Eligibility', item['subscriber_id'], '.pdf')
         eligibility_dict = {'eligibility': 'requested', 'subscriber_id': item['subscriber_id'], 'jobid': item['jobid'],
@@ -605,19 +1042,19 @@ class McnaSpider(scrapy.Spider):
                              identifier={'subscriber_id': item['subscriber_id'], 'jobid': item['jobid']},
                              field='eligibility',
                              name=filename)
-            response = self.zclient.send(json_data)
-            if not (response and response['status'] == 'ok'):
-                if self.scrape_mode == 'all':
-                    msg = 'Error occurred during printing eligibility info for member {} {} with facility ID {} for user "{}"' \
-                        .format(item['lname'], item['fname'], item['fid'], item['username'])
-                else:
-                    msg = 'Error occurred during printing eligibility info for member with mid {} and facility ID {} for user "{}"' \
-                        .format(item['mid'], item['fid'], item['username'])
-                self.logger.error(msg)
+            # Render in the background so slow PDFs overlap with scraping
+            d = self.renderer.render(json_data)
+            d.addBoth(self.render_finished, item)
 
         # Check TMHP eligibility if patient is on medicaid plan
         if 'MEDICAID' in item['plan']:
-            if self.tmhp:
-                yield self.tmhp.check_eligibility(item['subscriber_id'], item['dob'], item['fname'], item['lname'],
-                                                  item.get('company'), item.get('practice'), self.name)
+            check = self.check_tmhp(item)
+            if check:
+                yield check
 
+    def render_finished(self, response, item):
+        if not (isinstance(response, dict) and response.get('status') == 'ok'):
+            msg = 'Error occurred during printing eligibility info for member with mid {} and facility ID {} for user ' \
+                  '"{}": {}'.format(item['mid'], item['fid'], item['username'], response)
+            self.logger.error(msg)
+        self.crawler.signals.send_catch_log(signal=pdf_rendered, item=item, response=response, spider=self)
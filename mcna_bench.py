@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+# Offline replay benchmark for McnaSpider: a local mock MCNA portal plus a runner that drives the spider in
+# each scrape mode and reports throughput, peak RSS and per-callback CPU. --startup instead measures spider import
+# and construction time per mode in fresh interpreters.
+#
+#   python -m medical_scraper.spiders.mcna_bench --modes all partial validate --sizes 10 1000 50000
+#   python -m medical_scraper.spiders.mcna_bench --startup --modes all partial validate
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+from urllib.parse import parse_qs, urlparse
+
+from twisted.web import resource as web_resource
+
+# Recorded pages can replace these with --pages DIR/<name>.html, {placeholders} are filled per member
+pages = {
+    'homepage': '<html><script>var AUTH_TOKEN = "bench-token";</script></html>',
+    'roster': '<html><body><div id="headerText"><input id="facilityId" value="{fid}"/></div></body></html>',
+    'eligibility': '<html><body>\n'
+                   '<div class="eligLabel">Plan:</div>MEDICAID CHIP</div>\n'
+                   '<p>This member is currently active.</p>\n'
+                   '<p>Subscriber is Eligible</td>\n'
+                   '<p>This member is on the CHIP plan and became eligible for benefits on 01/01/2020.</p>\n'
+                   'Confirmation: #{mid}<br/>\n'
+                   '<table class="services"><tr><td>02/03/2021</td><td title="PROPHYLAXIS - CHILD">D1120</td></tr>'
+                   '</table>\n'
+                   '<a href="/provider/print/{mid}">Print Eligibility Confirmation</a>\n'
+                   '</body></html>',
+    'print': '<html><body><div><div class="infoLabel">Subscriber\'s Name:</div> {fname} {lname}</div></body></html>',
+}
+fid = 'F1'
+
+
+def make_members(size):
+    members = []
+    for i in range(size):
+        lname = '{}{}'.format(chr(ord('a') + i % 26), i)
+        members.append({'id': str(100000 + i), 'fname': 'first{}'.format(i), 'lname': lname, 'city': 'Austin',
+                        'patient_uuid': 'uuid-{}'.format(i), 'prov_lname': 'Doe', 'prov_fname': 'Jane',
+                        'prov_title': 'DDS', 'subscriber_id': str(500000 + i), 'dob': '01/02/2010'})
+    return members
+
+
+class MockPortal(web_resource.Resource):
+    # Serves every MCNA endpoint the spider uses from synthetic members, with latency and error injection
+    isLeaf = True
+    roster_page_limit = 500
+    # Only member info and verify eligibility know these, roster records don't carry them
+    member_info_only = ('subscriber_id', 'dob')
+
+    def __init__(self, members, latency=0.0, error_rate=0.0):
+        web_resource.Resource.__init__(self)
+        self.members = members
+        self.by_id = {m['id']: m for m in members}
+        self.by_subscriber = {m['subscriber_id']: m for m in members}
+        self.latency = latency
+        self.error_rate = error_rate
+        # Roster lists cut at roster_page_limit, the members past the limit can't be crawled
+        self.truncated_rosters = 0
+
+    def render(self, request):
+        from twisted.internet import reactor, task
+        from twisted.web import server
+        d = task.deferLater(reactor, self.latency, self.respond, request)
+        d.addErrback(lambda failure: request.finish())
+        return server.NOT_DONE_YET
+
+    def respond(self, request):
+        if random.random() < self.error_rate:
+            request.setResponseCode(500)
+            body = 'injected error'
+        else:
+            body = self.page(request.uri.decode('utf-8'))
+        request.setHeader(b'Content-Type', b'text/html; charset=utf-8')
+        request.write(body.encode('utf-8'))
+        request.finish()
+
+    def page(self, uri):
+        url = urlparse(uri)
+        query = {k: v[0] for k, v in parse_qs(url.query, keep_blank_values=True).items()}
+        path = url.path
+        if path == '/login/portal_user_authenticate.json':
+            return json.dumps({'portal_user_authenticate': {'response_message': 'OK'}})
+        if path == '/provider/members_roster':
+            return pages['roster'].format(fid=fid)
+        if path == '/provider/members_roster_list.json':
+            alpha = query.get('alpha', '')
+            records = [m for m in self.members if m['lname'].startswith(alpha)]
+            # Like the portal, report the full count but truncate long lists
+            if len(records) > self.roster_page_limit:
+                self.truncated_rosters += 1
+            shown = [{k: v for k, v in m.items() if k not in self.member_info_only}
+                     for m in records[:self.roster_page_limit]]
+            return json.dumps({'members_roster_list': {'num_recs': str(len(records)),
+                                                       'members': shown[0] if len(shown) == 1 else shown}})
+        if path == '/provider/get_member_info.json':
+            m = self.by_id[query['id']]
+            return json.dumps({'get_member_info': {'address1': '1 Main St', 'csz': 'Austin, TX 78701',
+                                                   'dob': m['dob'], 'telephone': '5125550100',
+                                                   'subscriber_id': m['subscriber_id']}})
+        if path == '/provider/verify_eligibility.json':
+            m = self.by_subscriber[query['verifySubscriberId']]
+            return json.dumps({'verify_eligibility': {'response_message': 'OK', 'insured': {'id': m['id']}}})
+        if path.startswith('/provider/eligible/'):
+            return pages['eligibility'].format(mid=path.split('/')[3])
+        if path.startswith('/provider/print/'):
+            m = self.by_id[path.split('/')[3]]
+            return pages['print'].format(fname=m['fname'], lname=m['lname'])
+        return pages['homepage']
+
+
+def run_once(mode, size, latency, error_rate, results):
+    from scrapy import signals
+    from scrapy.crawler import CrawlerProcess
+    from scrapy.utils.reactor import install_reactor
+
+    process = CrawlerProcess({'LOG_LEVEL': 'WARNING', 'TELNETCONSOLE_ENABLED': False})
+    # The mock portal needs the reactor before the crawl starts, install the one Scrapy is configured with
+    # first (the crawl then finds it in place) and only then import it and the spider
+    install_reactor(process.settings['TWISTED_REACTOR'], process.settings['ASYNCIO_EVENT_LOOP'])
+    from twisted.internet import reactor
+    from twisted.web import server
+    from .example import McnaSpider
+
+    members = make_members(size)
+    mock = MockPortal(members, latency, error_rate)
+    portal = reactor.listenTCP(0, server.Site(mock), interface='127.0.0.1')
+    portal_url = 'http://127.0.0.1:{}'.format(portal.getHost().port)
+    creds = [{'username': 'bench', 'password': 'bench', 'jobid': 'bench', 'company': 'bench', 'practice': 'bench',
+              'practice[]': '', 'facility_id': fid, 'tmhp_username': '', 'tmhp_password': ''}]
+    kwargs = {'creds': json.dumps(creds), 'scrape_mode': mode, 'portal_url': portal_url, 'alert_sink': 'log',
+              'renderer': 'fake'}
+    if mode == 'partial':
+        partial = [{'username': 'bench', 'jobid': 'bench', 'mid': m['id'] if i % 2 else '',
+                    'subscriber_id': m['subscriber_id'], 'fid': fid, 'dob': '2010-01-02'}
+                   for i, m in enumerate(members)]
+        members_file = tempfile.NamedTemporaryFile('w', suffix='.json', delete=False)
+        json.dump(partial, members_file)
+        members_file.close()
+        kwargs['members'] = '@' + members_file.name
+    crawler = process.create_crawler(McnaSpider)
+    # Members the crawl actually emitted a record for, status events and notices don't count
+    emitted = set()
+
+    def item_scraped(item):
+        if item.get('subscriber_id') and item.get('fid'):
+            emitted.add(item['subscriber_id'])
+    # Signal receivers are weakly referenced, item_scraped stays alive in this frame until the crawl is over
+    crawler.signals.connect(item_scraped, signal=signals.item_scraped)
+    process.crawl(crawler, **kwargs)
+    process.start()
+    stats = crawler.stats.get_stats()
+    elapsed = stats.get('elapsed_time_seconds') or 1e-9
+    results.put({
+        'mode': mode,
+        'members': size,
+        'emitted': len(emitted),
+        'truncated_rosters': mock.truncated_rosters,
+        'requests': stats.get('downloader/request_count', 0),
+        'requests_per_sec': stats.get('downloader/request_count', 0) / elapsed,
+        'members_per_sec': len(emitted) / elapsed,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        # Lowest per-account concurrency the AIMD throttle went down to, drops below the start with --error-rate
+        'min_concurrency': min([v for k, v in stats.items() if k.endswith('/min_concurrency')] or [0]),
+        'callback_cpu': {k.split('/')[2]: round(v, 3) for k, v in stats.items()
+                         if k.startswith('mcna/callback/') and k.endswith('/cpu_seconds')},
+    })
+    if mode == 'partial':
+        os.remove(members_file.name)
+
+
+# Run in a fresh interpreter per sample so nothing is imported yet
+startup_script = '''
+import json, resource, sys, time
+start = time.perf_counter()
+from {module} import McnaSpider
+imported = time.perf_counter()
+spider = McnaSpider(**json.loads(sys.argv[1]))
+created = time.perf_counter()
+print(json.dumps({{'import_ms': (imported - start) * 1000, 'init_ms': (created - imported) * 1000,
+                  'rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                  'loaded': [m for m in {heavy!r} if m in sys.modules]}}))
+'''
+heavy_modules = ('zmq', 'boto3', 'cryptography', 'bs4')
+
+
+def startup_once(mode):
+    creds = [{'username': 'bench', 'password': 'bench', 'jobid': 'bench', 'company': 'bench', 'practice': 'bench',
+              'practice[]': '', 'facility_id': fid, 'tmhp_username': '', 'tmhp_password': ''}]
+    kwargs = {'creds': json.dumps(creds), 'scrape_mode': mode}
+    if mode == 'partial':
+        kwargs['members'] = json.dumps([{'username': 'bench', 'jobid': 'bench', 'mid': '1', 'subscriber_id': '1',
+                                         'fid': fid, 'dob': '2010-01-02'}])
+    # __spec__ rather than __name__, which is '__main__' when run with -m
+    script = startup_script.format(module=__spec__.name.rpartition('.')[0] + '.example', heavy=heavy_modules)
+    output = subprocess.run([sys.executable, '-c', script, json.dumps(kwargs)], check=True, stdout=subprocess.PIPE)
+    return json.loads(output.stdout.decode('utf-8').strip().splitlines()[-1])
+
+
+def startup(modes, runs):
+    print('{:<9} {:>10} {:>8} {:>9}  heavy modules loaded'.format('mode', 'import ms', 'init ms', 'rss MB'))
+    for mode in modes:
+        samples = [startup_once(mode) for _ in range(runs)]
+        best = min(samples, key=lambda sample: sample['import_ms'] + sample['init_ms'])
+        print('{:<9} {:>10.1f} {:>8.1f} {:>9.1f}  {}'.format(mode, best['import_ms'], best['init_ms'], best['rss_mb'],
+                                                             ', '.join(best['loaded']) or '-'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark McnaSpider against a local mock MCNA portal')
+    parser.add_argument('--modes', nargs='+', default=['all', 'partial', 'validate'])
+    parser.add_argument('--sizes', nargs='+', type=int, default=[10, 1000, 50000])
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every portal response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of portal responses that fail')
+    parser.add_argument('--pages', help='directory of recorded pages overriding the built-in ones')
+    parser.add_argument('--startup', action='store_true', help='measure spider startup per mode instead')
+    parser.add_argument('--startup-runs', type=int, default=5, help='fresh interpreters per mode, best is shown')
+    args = parser.parse_args()
+    if args.startup:
+        startup(args.modes, args.startup_runs)
+        return
+    if args.pages:
+        for name in pages:
+            path = os.path.join(args.pages, name + '.html')
+            if os.path.exists(path):
+                with open(path, encoding='utf-8') as f:
+                    pages[name] = f.read()
+    results = multiprocessing.Queue()
+    print('{:<9} {:>8} {:>8} {:>9} {:>10} {:>11} {:>9} {:>9}  callback cpu seconds'.format(
+        'mode', 'members', 'emitted', 'requests', 'req/s', 'members/s', 'rss MB', 'min conc'))
+    for mode in args.modes:
+        for size in args.sizes:
+            # A reactor can only run once per process, so every run gets its own
+            worker = multiprocessing.Process(target=run_once,
+                                             args=(mode, size, args.latency, args.error_rate, results))
+            worker.start()
+            worker.join()
+            if worker.exitcode != 0:
+                print('{:<9} {:>8}  failed with exit code {}'.format(mode, size, worker.exitcode))
+                continue
+            result = results.get()
+            print('{mode:<9} {members:>8} {emitted:>8} {requests:>9} {requests_per_sec:>10.1f} '
+                  '{members_per_sec:>11.1f} {peak_rss_mb:>9.1f} {min_concurrency:>9}  {callback_cpu}'.format(**result))
+            if result['truncated_rosters']:
+                print('{:<9} {:>8}  {} roster lists truncated at {} members, members/s only counts emitted '
+                      'members'.format(mode, size, result['truncated_rosters'], MockPortal.roster_page_limit))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+
+class StatusEvent(dict):
+    # Sync status item with the original keys (mco_sync_status, one_member, ...), carrying the ids of the request's
+    # item and never its creds. McnaSpider.resolve_members gives the members it applies to.
+    id_fields = ('jobid', 'username', 'company', 'practice', 'facility_id', 'fid', 'mid', 'subscriber_id')
+
+    def __init__(self, status, item, one_member=False):
+        dict.__init__(self, ((f, item[f]) for f in self.id_fields if f in item))
+        if 'username' not in self and 'creds' in item:
+            self['username'] = item['creds']['username']
+        self['mco_sync_status'] = status
+        if one_member:
+            self['one_member'] = one_member
+
+
+class MemberRecord(object):
+    # Slotted member record passed along the request chain instead of a growing dict. It supports the dict
+    # operations the callbacks use, keys outside the known fields (e.g. extra partial mode input columns) go to
+    # a small overflow dict. Yield dict(record) as the item.
+    fields = ('jobid', 'company', 'practice', 'facility_id', 'username', 'fid', 'mid', 'subscriber_id', 'dob',
+              'fname', 'lname', 'city', 'dentist', 'patient_uuid', 'address', 'telephone', 'new_patient',
+              'mco_sync_status', 'mco_status', 'plan', 'became_eligible_on', 'confirmation_no', 'last_service_date',
+              'last_prophylaxis_date')
+    field_set = frozenset(fields)
+    __slots__ = fields + ('extra',)
+
+    def __init__(self, data=None, **kwargs):
+        self.extra = None
+        if data:
+            self.update(data)
+        if kwargs:
+            self.update(kwargs)
+
+    def __setitem__(self, key, value):
+        if key in self.field_set:
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = dict()
+            self.extra[key] = value
+
+    def __getitem__(self, key):
+        if key in self.field_set:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self.extra is None:
+            raise KeyError(key)
+        return self.extra[key]
+
+    def __contains__(self, key):
+        if key in self.field_set:
+            return hasattr(self, key)
+        return self.extra is not None and key in self.extra
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def keys(self):
+        keys = [f for f in self.fields if hasattr(self, f)]
+        if self.extra:
+            keys.extend(self.extra)
+        return keys
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def pop(self, key, *default):
+        try:
+            value = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        if key in self.field_set:
+            delattr(self, key)
+        else:
+            del self.extra[key]
+        return value
+
+    def update(self, other):
+        for key, value in (other.items() if hasattr(other, 'items') else other):
+            self[key] = value
+
+    def copy(self):
+        return MemberRecord(self)
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+# Run queued MCNA jobs on a fixed number of local worker processes. Interactive jobs (partial and validate
+# checks) start ahead of bulk syncs and have workers reserved for them. A bulk job that has waited longer than
+# max_bulk_wait starts ahead of newer interactive jobs on the shared workers, so bulk jobs are never starved.
+# Jobs are submitted as JSON files of spider arguments dropped into the spool directory.
+#
+#   python -m medical_scraper.spiders.mcna_jobs spool/ --workers 4 --interactive-workers 1 --stats jobs.prom
+import argparse
+import json
+import logging
+import os
+import subprocess
+import time
+from collections import deque
+
+from .mcna_metrics import latency_buckets, prometheus_text
+
+logger = logging.getLogger(__name__)
+job_classes = ('interactive', 'bulk')
+
+
+def job_class(spider_args):
+    return 'interactive' if spider_args.get('scrape_mode') in ('partial', 'validate') else 'bulk'
+
+
+class Job(object):
+    def __init__(self, name, spider_args, output):
+        self.name = name
+        self.spider_args = spider_args
+        self.output = output
+        self.job_class = job_class(spider_args)
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.process = None
+
+
+class JobScheduler(object):
+    def __init__(self, workers=4, interactive_workers=1, max_bulk_wait=900, interactive_sla=30):
+        # Bulk jobs only run on the shared workers, with none left they would wait forever
+        if interactive_workers >= workers:
+            raise ValueError('interactive_workers ({}) must leave at least one of the {} workers shared'.format(
+                interactive_workers, workers))
+        self.workers = workers
+        self.interactive_workers = interactive_workers
+        self.max_bulk_wait = max_bulk_wait
+        self.interactive_sla = interactive_sla
+        self.queues = {c: deque() for c in job_classes}
+        self.running = []
+        self.stats = dict()
+
+    def inc(self, key, value=1):
+        self.stats[key] = self.stats.get(key, 0) + value
+
+    def submit(self, name, spider_args, output):
+        job = Job(name, spider_args, output)
+        self.queues[job.job_class].append(job)
+        self.inc('mcna/jobs/{}/submitted'.format(job.job_class))
+        return job
+
+    # Next job to start on a free worker, None when nothing queued may start yet
+    def next_job(self):
+        interactive, bulk = self.queues['interactive'], self.queues['bulk']
+        bulk_running = sum(1 for job in self.running if job.job_class == 'bulk')
+        bulk_allowed = bulk and bulk_running < self.workers - self.interactive_workers
+        if bulk_allowed and (not interactive or time.time() - bulk[0].submitted_at > self.max_bulk_wait):
+            if interactive:
+                self.inc('mcna/jobs/bulk/promoted')
+            return bulk.popleft()
+        if interactive:
+            return interactive.popleft()
+        return None
+
+    def start(self, job):
+        cmd = ['scrapy', 'crawl', 'mcna', '-O', job.output + ':jsonlines']
+        for name, value in job.spider_args.items():
+            cmd += ['-a', '{}={}'.format(name, value)]
+        job.started_at = time.time()
+        job.process = subprocess.Popen(cmd)
+        self.running.append(job)
+        wait = job.started_at - job.submitted_at
+        # Exported as one mcna_job_queue_latency_seconds histogram per job class
+        for bucket in latency_buckets:
+            if wait <= bucket:
+                self.inc('mcna/job_queue_latency/{}/le_{}'.format(job.job_class, bucket))
+        self.inc('mcna/job_queue_latency/{}/count'.format(job.job_class))
+        self.inc('mcna/job_queue_latency/{}/sum'.format(job.job_class), wait)
+        key = 'mcna/jobs/{}/max_queue_seconds'.format(job.job_class)
+        self.stats[key] = max(self.stats.get(key, 0), round(wait, 3))
+        if job.job_class == 'interactive' and wait > self.interactive_sla:
+            self.inc('mcna/jobs/interactive/sla_missed')
+        logger.info('Started %s job %s after %.1fs in queue', job.job_class, job.name, wait)
+
+    def reap(self):
+        for job in list(self.running):
+            code = job.process.poll()
+            if code is None:
+                continue
+            self.running.remove(job)
+            self.inc('mcna/jobs/{}/{}'.format(job.job_class, 'finished' if code == 0 else 'failed'))
+            logger.info('%s job %s exited with %s after %.1fs', job.job_class, job.name, code,
+                        time.time() - job.started_at)
+
+    def dispatch(self):
+        while len(self.running) < self.workers:
+            job = self.next_job()
+            if job is None:
+                break
+            self.start(job)
+        for c in job_classes:
+            self.stats['mcna/jobs/{}/queued'.format(c)] = len(self.queues[c])
+            self.stats['mcna/jobs/{}/running'.format(c)] = sum(1 for job in self.running if job.job_class == c)
+
+
+# Move new job files out of the spool and submit them in arrival order
+def collect(scheduler, spool):
+    started = os.path.join(spool, 'started')
+    os.makedirs(started, exist_ok=True)
+    names = [n for n in os.listdir(spool) if n.endswith('.json')]
+    for name in sorted(names, key=lambda n: os.path.getmtime(os.path.join(spool, n))):
+        path = os.path.join(started, name)
+        os.replace(os.path.join(spool, name), path)
+        with open(path, encoding='utf-8') as f:
+            spider_args = json.load(f)
+        scheduler.submit(name, spider_args, os.path.splitext(path)[0] + '.jl')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run MCNA jobs from a spool directory, interactive jobs first')
+    parser.add_argument('spool', help='directory polled for job files of spider arguments')
+    parser.add_argument('-n', '--workers', type=int, default=4)
+    parser.add_argument('--interactive-workers', type=int, default=1, help='workers bulk jobs may not take')
+    parser.add_argument('--max-bulk-wait', type=float, default=900, help='seconds before a bulk job jumps ahead')
+    parser.add_argument('--interactive-sla', type=float, default=30, help='queue seconds counted as SLA misses')
+    parser.add_argument('--stats', help='file rewritten with Prometheus text of the queue stats')
+    parser.add_argument('--poll', type=float, default=1.0)
+    args = parser.parse_args()
+    if args.interactive_workers >= args.workers:
+        parser.error('--interactive-workers must be lower than --workers, bulk jobs need a shared worker')
+    logging.basicConfig(level=logging.INFO)
+    scheduler = JobScheduler(args.workers, args.interactive_workers, args.max_bulk_wait, args.interactive_sla)
+    while True:
+        collect(scheduler, args.spool)
+        scheduler.reap()
+        scheduler.dispatch()
+        if args.stats:
+            with open(args.stats, 'w', encoding='utf-8') as f:
+                f.write(prometheus_text(scheduler.stats))
+        time.sleep(args.poll)
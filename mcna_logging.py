@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import time
+from collections import deque
+
+# Characters of a response body that make it into log lines and alerts
+body_preview_limit = 500
+
+
+class BodyPreview(object):
+    # Truncated response body for log arguments, only built when the record is actually formatted
+    def __init__(self, text, limit=body_preview_limit):
+        self.text = text
+        self.limit = limit
+
+    def __str__(self):
+        if len(self.text) <= self.limit:
+            return self.text
+        return '{}... [{} more chars]'.format(self.text[:self.limit], len(self.text) - self.limit)
+
+
+class ResponseCapture(object):
+    # Full response bodies written to a directory on request, keeping only the most recent max_files
+    def __init__(self, path, max_files=200):
+        self.path = path
+        self.files = deque()
+        self.max_files = max_files
+        os.makedirs(path, exist_ok=True)
+
+    def capture(self, stage, response):
+        name = '{}_{}_{}.html'.format(time.strftime('%Y%m%d-%H%M%S'), stage, re.sub(r'\W+', '_', response.url)[-80:])
+        filename = os.path.join(self.path, name)
+        with open(filename, 'wb') as f:
+            f.write(response.body)
+        self.files.append(filename)
+        while len(self.files) > self.max_files:
+            try:
+                os.remove(self.files.popleft())
+            except OSError:
+                pass
+        return filename
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+import re
+import time
+
+from scrapy import signals
+from twisted.internet import task
+
+# Upper bounds in seconds of the download and queue latency histogram buckets
+latency_buckets = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, float('inf'))
+# Histogram stats under mcna/<kind>/<label value>/, exported as (metric name, label name)
+histogram_kinds = {'latency': ('mcna_download_latency_seconds', 'endpoint'),
+                   'queue_latency': ('mcna_queue_latency_seconds', 'request_class'),
+                   'job_queue_latency': ('mcna_job_queue_latency_seconds', 'job_class')}
+
+
+def callback_name(request):
+    return getattr(request.callback, '__name__', None) or 'parse'
+
+
+# Add wall and CPU seconds to a callback's timing stats, also used for work a callback hands off to the parse pool
+def record_callback_time(stats, name, wall, cpu):
+    stats.inc_value('mcna/callback/{}/wall_seconds'.format(name), wall)
+    stats.inc_value('mcna/callback/{}/cpu_seconds'.format(name), cpu)
+
+
+class CallbackTimerMiddleware(object):
+    # Wall and CPU time spent inside each spider callback, measured while Scrapy consumes its output.
+    # Install closest to the spider so other middlewares are not included.
+    def __init__(self, stats):
+        self.stats = stats
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler.stats)
+
+    def process_spider_output(self, response, result):
+        name = callback_name(response.request) if response.request else 'parse'
+        wall = cpu = 0.0
+        result = iter(result)
+        while True:
+            wall_start, cpu_start = time.perf_counter(), time.thread_time()
+            try:
+                r = next(result)
+            except StopIteration:
+                break
+            finally:
+                wall += time.perf_counter() - wall_start
+                cpu += time.thread_time() - cpu_start
+            yield r
+        self.record(name, wall, cpu)
+
+    async def process_spider_output_async(self, response, result):
+        name = callback_name(response.request) if response.request else 'parse'
+        wall = cpu = 0.0
+        while True:
+            wall_start, cpu_start = time.perf_counter(), time.thread_time()
+            try:
+                r = await result.__anext__()
+            except StopAsyncIteration:
+                break
+            finally:
+                wall += time.perf_counter() - wall_start
+                cpu += time.thread_time() - cpu_start
+            yield r
+        # Awaited work handed off by the callback ran interleaved with everything else on the reactor thread,
+        # whoever did it records its time
+        waited_wall, waited_cpu = response.meta.get('callback_waited', (0.0, 0.0))
+        self.record(name, max(wall - waited_wall, 0.0), max(cpu - waited_cpu, 0.0))
+
+    def record(self, name, wall, cpu):
+        self.stats.inc_value('mcna/callback/{}/count'.format(name))
+        record_callback_time(self.stats, name, wall, cpu)
+
+
+class CrawlMetrics(object):
+    # Per-endpoint latency histograms, per-account request and error counters, scheduler queue depth and
+    # per-request-class queue latency in Scrapy stats, dumped in Prometheus text format at close when
+    # MCNA_METRICS_FILE is set
+    def __init__(self, crawler):
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.metrics_file = crawler.settings.get('MCNA_METRICS_FILE')
+        self.queue_sampler = task.LoopingCall(self.sample_queue)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        ext = cls(crawler)
+        crawler.signals.connect(ext.spider_opened, signal=signals.spider_opened)
+        crawler.signals.connect(ext.spider_closed, signal=signals.spider_closed)
+        crawler.signals.connect(ext.response_received, signal=signals.response_received)
+        crawler.signals.connect(ext.request_scheduled, signal=signals.request_scheduled)
+        crawler.signals.connect(ext.request_reached_downloader, signal=signals.request_reached_downloader)
+        return ext
+
+    def spider_opened(self, spider):
+        self.queue_sampler.start(5, now=False)
+
+    def sample_queue(self):
+        engine = self.crawler.engine
+        slot = getattr(engine, '_slot', None) or getattr(engine, 'slot', None)
+        if slot is None:
+            return
+        depth = len(slot.scheduler)
+        self.stats.set_value('mcna/queue/depth', depth)
+        self.stats.max_value('mcna/queue/max_depth', depth)
+        self.stats.set_value('mcna/queue/downloader_active', len(self.crawler.engine.downloader.active))
+
+    def observe(self, kind, label, value):
+        for bucket in latency_buckets:
+            if value <= bucket:
+                self.stats.inc_value('mcna/{}/{}/le_{}'.format(kind, label, bucket))
+        self.stats.inc_value('mcna/{}/{}/count'.format(kind, label))
+        self.stats.inc_value('mcna/{}/{}/sum'.format(kind, label), value)
+
+    def request_scheduled(self, request, spider):
+        request.meta['scheduled_at'] = time.time()
+
+    # Time requests spent in the scheduler queue per request class, popped so a retry is measured afresh. Retries
+    # wait out their backoff before they are scheduled again, so the retry delay is not counted as queue latency
+    def request_reached_downloader(self, request, spider):
+        scheduled_at = request.meta.pop('scheduled_at', None)
+        if scheduled_at is None:
+            return
+        request_class = request.meta.get('request_class', 'bulk')
+        wait = time.time() - scheduled_at
+        self.observe('queue_latency', request_class, wait)
+        self.stats.max_value('mcna/queue_latency/{}/max'.format(request_class), round(wait, 3))
+
+    def response_received(self, response, request, spider):
+        latency = request.meta.get('download_latency')
+        if latency is not None:
+            self.observe('latency', callback_name(request), latency)
+        account = request.meta.get('cookiejar')
+        if account is not None:
+            self.stats.inc_value('mcna/account/{}/requests'.format(account))
+            if response.status >= 400:
+                self.stats.inc_value('mcna/account/{}/errors'.format(account))
+
+    def spider_closed(self, spider, reason):
+        if self.queue_sampler.running:
+            self.queue_sampler.stop()
+        path = getattr(spider, 'metrics_file', None) or self.metrics_file
+        if path:
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(prometheus_text(self.stats.get_stats()))
+
+
+# Numeric stats as Prometheus text, the histogram_kinds keys as one histogram per label value
+def prometheus_text(stats):
+    lines = []
+    histograms = {kind: dict() for kind in histogram_kinds}
+    for key, value in sorted(stats.items()):
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            continue
+        histogram = re.match(r'mcna/({})/([^/]+)/(le_.+|count|sum)$'.format('|'.join(histogram_kinds)), key)
+        if histogram:
+            histograms[histogram.group(1)].setdefault(histogram.group(2), dict())[histogram.group(3)] = value
+            continue
+        lines.append('scrapy_stat{{name="{}"}} {}'.format(key.replace('"', '\\"'), value))
+    for kind, (metric, label) in sorted(histogram_kinds.items()):
+        if histograms[kind]:
+            lines.append('# TYPE {} histogram'.format(metric))
+        for name, values in sorted(histograms[kind].items()):
+            for bucket in latency_buckets:
+                le = '+Inf' if bucket == float('inf') else bucket
+                lines.append('{}_bucket{{{}="{}",le="{}"}} {}'.format(metric, label, name, le,
+                                                                     values.get('le_{}'.format(bucket), 0)))
+            lines.append('{}_count{{{}="{}"}} {}'.format(metric, label, name, values.get('count', 0)))
+            lines.append('{}_sum{{{}="{}"}} {}'.format(metric, label, name, values.get('sum', 0)))
+    return '\n'.join(lines) + '\n'
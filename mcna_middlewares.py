@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+from scrapy import Request
+from scrapy.http import Headers
+from scrapy.responsetypes import responsetypes
+
+# Responses that mean the portal wants us to slow down
+throttle_statuses = (429, 500, 502, 503, 504)
+
+
+class AccountSlotMiddleware(object):
+    # Give every account (cookiejar) its own downloader slot so concurrency is limited per account and the
+    # downloader aware priority queue schedules fairly across accounts
+    def process_start_requests(self, start_requests, spider):
+        for request in start_requests:
+            yield self.assign_slot(request)
+
+    async def process_start(self, start):
+        async for r in start:
+            yield self.assign_slot(r) if isinstance(r, Request) else r
+
+    def process_spider_output(self, response, result):
+        for r in result:
+            yield self.assign_slot(r) if isinstance(r, Request) else r
+
+    async def process_spider_output_async(self, response, result):
+        async for r in result:
+            yield self.assign_slot(r) if isinstance(r, Request) else r
+
+    @staticmethod
+    def assign_slot(request):
+        jar = request.meta.get('cookiejar')
+        if jar is not None:
+            request.meta.setdefault('download_slot', 'account:{}'.format(jar))
+        return request
+
+
+class RequestClassMiddleware(object):
+    # Tag requests as 'interactive' (partial and validate runs, eligibility lookups) or 'bulk' (roster sync) and
+    # raise interactive ones by REQUEST_CLASS_PRIORITY, so they leave the queue ahead of queued bulk traffic
+    interactive_callbacks = ('parse_verify_eligibility', 'parse_member_eligibility', 'parse_print_eligibility')
+
+    def __init__(self, crawler, priority):
+        self.crawler = crawler
+        self.priority = priority
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler, crawler.settings.getint('REQUEST_CLASS_PRIORITY', 10))
+
+    def process_start_requests(self, start_requests, spider):
+        for request in start_requests:
+            yield self.classify(request, spider)
+
+    async def process_start(self, start):
+        async for r in start:
+            yield self.classify(r, self.crawler.spider) if isinstance(r, Request) else r
+
+    def process_spider_output(self, response, result):
+        for r in result:
+            yield self.classify(r, self.crawler.spider) if isinstance(r, Request) else r
+
+    async def process_spider_output_async(self, response, result):
+        async for r in result:
+            yield self.classify(r, self.crawler.spider) if isinstance(r, Request) else r
+
+    def classify(self, request, spider):
+        # Retries keep their class and priority
+        if 'request_class' in request.meta:
+            return request
+        if getattr(spider, 'scrape_mode', 'all') in ('partial', 'validate') or \
+                getattr(request.callback, '__name__', None) in self.interactive_callbacks:
+            request.meta['request_class'] = 'interactive'
+            request.priority += self.priority
+        else:
+            request.meta['request_class'] = 'bulk'
+        return request
+
+
+class AccountThrottleMiddleware(object):
+    # AIMD concurrency per account slot: one more concurrent request after each fast successful response,
+    # halved on download errors and throttling responses. Install above RetryMiddleware (550), which otherwise
+    # turns throttling responses and connection errors into retries before they get here. Current and lowest
+    # limits and latency go to stats.
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.crawler = crawler
+        self.stats = crawler.stats
+        self.start_concurrency = settings.getint('ACCOUNT_CONCURRENCY_START', 2)
+        self.max_concurrency = settings.getint('ACCOUNT_CONCURRENCY_MAX', 8)
+        self.target_latency = settings.getfloat('ACCOUNT_TARGET_LATENCY', 5.0)
+        self.latency = dict()
+        # Downloader slots already started at the starting concurrency, the downloader replaces idle ones
+        self.slots = dict()
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def slot(self, request):
+        key = request.meta.get('download_slot', '')
+        if not key.startswith('account:'):
+            return None
+        slot = self.crawler.engine.downloader.slots.get(key)
+        if slot is not None and self.slots.get(key) is not slot:
+            self.slots[key] = slot
+            self.adjust(request.meta.get('cookiejar'), slot, self.start_concurrency)
+        return slot
+
+    def process_request(self, request):
+        # Start accounts at the starting concurrency as soon as the downloader has created their slot
+        self.slot(request)
+
+    def process_response(self, request, response):
+        slot = self.slot(request)
+        if slot is None or 'cached' in response.flags:
+            return response
+        jar = request.meta.get('cookiejar')
+        latency = request.meta.get('download_latency', 0)
+        # Exponential moving average keeps one slow page from swinging the limit
+        self.latency[jar] = 0.8 * self.latency.get(jar, latency) + 0.2 * latency
+        self.stats.set_value('mcna/account/{}/latency'.format(jar), round(self.latency[jar], 3))
+        if response.status in throttle_statuses:
+            self.decrease(jar, slot)
+        elif self.latency[jar] < self.target_latency:
+            self.adjust(jar, slot, min(self.max_concurrency, slot.concurrency + 1))
+        else:
+            self.decrease(jar, slot)
+        return response
+
+    def process_exception(self, request, exception):
+        slot = self.slot(request)
+        if slot is not None:
+            self.decrease(request.meta.get('cookiejar'), slot)
+
+    def decrease(self, jar, slot):
+        self.adjust(jar, slot, max(1, slot.concurrency // 2))
+
+    def adjust(self, jar, slot, concurrency):
+        slot.concurrency = concurrency
+        self.stats.set_value('mcna/account/{}/concurrency'.format(jar), concurrency)
+        self.stats.min_value('mcna/account/{}/min_concurrency'.format(jar), concurrency)
+
+
+class EndpointCacheMiddleware(object):
+    # Serve member info, eligibility and print pages from spider.response_cache, keyed by the endpoint and the
+    # member's (username, mid, subscriber_id, fid)
+    endpoints = {'parse_member_info': 'member_info',
+                 'parse_member_eligibility': 'eligibility',
+                 'parse_print_eligibility': 'print'}
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    @classmethod
+    def cache_key(cls, request):
+        endpoint = cls.endpoints.get(getattr(request.callback, '__name__', None))
+        item = request.meta.get('item')
+        if not endpoint or not item:
+            return None
+        return '|'.join([endpoint] + [str(item.get(f, '')) for f in ('username', 'mid', 'subscriber_id', 'fid')])
+
+    def process_request(self, request):
+        spider = self.crawler.spider
+        cache = getattr(spider, 'response_cache', None)
+        # Retries are for bad responses, don't hand the same cached body back
+        if cache is None or request.meta.get(spider.retry_meta_key):
+            return None
+        key = self.cache_key(request)
+        cached = cache.get(key) if key else None
+        if cached is None:
+            return None
+        url, status, content_type, body = cached
+        self.crawler.stats.inc_value('mcna/response_cache/hit')
+        headers = Headers({'Content-Type': content_type})
+        respcls = responsetypes.from_args(headers=headers, url=url, body=body)
+        return respcls(url=url, status=status, headers=headers, body=body, request=request, flags=['cached'])
+
+    def process_response(self, request, response):
+        cache = getattr(self.crawler.spider, 'response_cache', None)
+        if cache is None or response.status != 200 or 'cached' in response.flags:
+            return response
+        # A redirected request landed somewhere else, e.g. the login page of an expired session
+        if request.meta.get('redirect_urls') or response.url != request.url:
+            self.crawler.stats.inc_value('mcna/response_cache/redirected')
+            return response
+        key = self.cache_key(request)
+        if key:
+            content_type = response.headers.get('Content-Type', b'').decode('latin-1')
+            cache.put(key, response.url, response.status, content_type, response.body)
+        return response
@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+import json
+import multiprocessing
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from lxml import html
+from twisted.internet import defer
+
+# Patterns are anchored on a literal prefix: search_from() jumps to the prefix with str.find and matches from
+# there. Like the re.search('... .*') lookups they replace, greedy groups run to the end of the line, on a
+# minified page that is the rest of the page.
+auth_token_prefix = 'AUTH_TOKEN = "'
+auth_token_re = re.compile(r'AUTH_TOKEN = "([^\n]*)";')
+plan_prefix = '<div class="eligLabel">Plan:</div>'
+plan_re = re.compile(r'<div class="eligLabel">Plan:</div>([^\n]*)</div>')
+eligible_on_prefix = 'This member is on the '
+eligible_on_re = re.compile(r'This member is on the [^\n]* plan and became eligible for benefits on (\d+/\d+/\d+).')
+currently_prefix = 'This member is currently '
+currently_re = re.compile(r'This member is currently [^\n]*')
+subscriber_prefix = 'Subscriber is '
+subscriber_re = re.compile(r'Subscriber is [^\n]*')
+confirmation_prefix = 'Confirmation: #'
+confirmation_re = re.compile(r'Confirmation: (#\d+)<br/>')
+
+services_table_xpath = '(//table[contains(concat(" ", normalize-space(@class), " "), " services ")])[last()]'
+prophylaxis_xpath = '(//td[@title="{}"])[1]'
+print_link_xpath = '(//a[count(node()) = 1 and text() = "Print Eligibility Confirmation"])[1]/@href'
+facility_input_xpath = '(//input[@id="facilityId"])[1]/@value'
+facility_options_xpath = '(//div[@id="headerText"])[1]//option'
+subscriber_name_xpath = '(//div[contains(concat(" ", normalize-space(@class), " "), " infoLabel ")]' \
+                        '[text() = "Subscriber\'s Name:"])[1]/..'
+
+
+def search_from(pattern, prefix, data):
+    start = data.find(prefix)
+    while start != -1:
+        match = pattern.match(data, start)
+        if match:
+            return match
+        start = data.find(prefix, start + 1)
+    return None
+
+
+def first_td_text(element):
+    td = element.xpath('(.//td)[1]')
+    return td[0].text_content() if td else None
+
+
+# Login form token from the homepage, None when missing
+def parse_auth_token(data):
+    auth_token = search_from(auth_token_re, auth_token_prefix, data)
+    return auth_token.group(1) if auth_token else None
+
+
+# Facility ids assigned to the user as (id, name) pairs, from the single facility input or the selection box
+def parse_facility_ids(data):
+    tree = html.fromstring(data)
+    fid = tree.xpath(facility_input_xpath)
+    if fid and fid[0] != '':
+        return [(str(fid[0]), '')]
+    facilities = tree.xpath(facility_options_xpath)
+    if not facilities and not tree.xpath('//div[@id="headerText"]'):
+        raise ValueError('Facility selection not found on roster page')
+    # Skip 0 which is 'Select a Facility'
+    return [(f.get('value'), f.text_content()) for f in facilities if f.get('value') != '0']
+
+
+# Reported record count and member records from a members_roster_list.json response,
+# a single record comes back as a dict
+def parse_roster(data):
+    roster = json.loads(data)['members_roster_list']
+    num_recs = roster['num_recs']
+    if num_recs == '0':
+        return 0, []
+    if num_recs == '1':
+        return 1, [roster['members']]
+    return int(num_recs), roster['members']
+
+
+def parse_member_info(data):
+    info = json.loads(data)['get_member_info']
+    return {'address': '{} {}'.format(info['address1'], info['csz']),
+            'dob': info['dob'],
+            'telephone': info['telephone'],
+            'subscriber_id': info['subscriber_id']}
+
+
+# Extract everything parse_member_eligibility needs from the eligibility page in a single lxml pass.
+# 'active' and 'eligible' are None when the status lines are missing, in which case only 'plan' is set.
+def parse_eligibility_page(data):
+    plan = search_from(plan_re, plan_prefix, data)
+    result = {'plan': plan.group(1) if plan else '', 'active': None, 'eligible': None}
+    currently = search_from(currently_re, currently_prefix, data)
+    subscriber = search_from(subscriber_re, subscriber_prefix, data)
+    if not (currently and subscriber):
+        return result
+    result['active'] = 'active' in currently.group(0)
+    result['eligible'] = 'eligible' in subscriber.group(0)[:-5].lower()
+
+    eg_date = search_from(eligible_on_re, eligible_on_prefix, data)
+    result['became_eligible_on'] = eg_date.group(1) if eg_date else ''
+    confirmation_no = search_from(confirmation_re, confirmation_prefix, data)
+    result['confirmation_no'] = confirmation_no.group(1) if confirmation_no else ''
+
+    tree = html.fromstring(data)
+    # IndexError when the page has no services table, same as the previous soup lookup
+    services_table = tree.xpath(services_table_xpath)[-1]
+    result['last_service_date'] = first_td_text(services_table) or ''
+
+    # First check if adult prophy present as data is ordered chronologically in the html page
+    prophylaxis = tree.xpath(prophylaxis_xpath.format('PROPHYLAXIS - ADULT')) or \
+        tree.xpath(prophylaxis_xpath.format('PROPHYLAXIS - CHILD'))
+    last_prophylaxis_date = ''
+    if prophylaxis:
+        # Walk rows backwards from the prophylaxis cell, nearest first
+        for row in reversed(prophylaxis[0].xpath('preceding::tr | ancestor::tr')):
+            text = first_td_text(row)
+            if text:
+                last_prophylaxis_date = text
+                break
+    result['last_prophylaxis_date'] = last_prophylaxis_date
+
+    print_link = tree.xpath(print_link_xpath)
+    result['print_link'] = str(print_link[0]) if print_link else None
+    return result
+
+
+# Subscriber first and last name from the print eligibility page
+def parse_subscriber_name(data):
+    label = html.fromstring(data).xpath(subscriber_name_xpath)[0]
+    fname, lname = label.text_content().split(':')[-1].strip().split(' ', 1)
+    return fname, lname
+
+
+def timed(parser, data):
+    # Run the parser and return its result with the wall and CPU seconds it took, in whichever process ran it
+    wall_start, cpu_start = time.perf_counter(), time.thread_time()
+    result = parser(data)
+    return result, time.perf_counter() - wall_start, time.thread_time() - cpu_start
+
+
+class ParsePool(object):
+    # Run parsers on response bodies in worker processes so big pages don't stall downloads on the reactor
+    # thread, the extracted result comes back through a Deferred. With no workers, or once the pool is broken,
+    # parsers run inline. Parse time is handed to record(name, wall, cpu) for the callback the parse belongs to,
+    # it happens outside the callback's own output so the callback timer can't see it.
+    def __init__(self, workers=0, record=None):
+        # Spawned rather than forked, the crawler process has the reactor's threads running
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) \
+            if workers > 0 else None
+        self.record = record
+
+    def run(self, parser, data, name=None):
+        d = self.submit(parser, data)
+        d.addCallback(self._timed, name)
+        return d
+
+    def submit(self, parser, data):
+        if self.executor is None:
+            return defer.maybeDeferred(timed, parser, data)
+        try:
+            future = self.executor.submit(timed, parser, data)
+        except (BrokenProcessPool, RuntimeError):
+            self.executor = None
+            return defer.maybeDeferred(timed, parser, data)
+        d = defer.Deferred()
+        # Imported here, Scrapy installs its reactor after the spider modules are loaded
+        from twisted.internet import reactor
+        future.add_done_callback(lambda f: reactor.callFromThread(self._resolve, f, d, parser, data))
+        return d
+
+    def _resolve(self, future, d, parser, data):
+        error = future.exception()
+        if isinstance(error, BrokenProcessPool):
+            self.executor = None
+            defer.maybeDeferred(timed, parser, data).chainDeferred(d)
+        elif error is not None:
+            d.errback(error)
+        else:
+            d.callback(future.result())
+
+    def _timed(self, timed_result, name):
+        result, wall, cpu = timed_result
+        if self.record is not None and name is not None:
+            self.record(name, wall, cpu)
+        return result
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+
+# Replay saved pages through the parsers and report per-callback parse time:
+#   python mcna_parsers.py --homepage home.html --roster roster.html --eligibility eligibility.html
+if __name__ == '__main__':
+    import argparse
+    import timeit
+
+    parsers = [('parse_homepage', 'homepage', parse_auth_token),
+               ('parse_facility_id', 'roster', parse_facility_ids),
+               ('parse_members', 'roster_list', parse_roster),
+               ('parse_member_info', 'member_info', parse_member_info),
+               ('parse_member_eligibility', 'eligibility', parse_eligibility_page),
+               ('parse_print_eligibility', 'print_eligibility', parse_subscriber_name)]
+    arg_parser = argparse.ArgumentParser(description='Micro-benchmark MCNA response parsing on saved pages')
+    for _, page, _ in parsers:
+        arg_parser.add_argument('--' + page.replace('_', '-'), dest=page, help='saved {} response'.format(page))
+    arg_parser.add_argument('-n', '--number', type=int, default=200, help='parses per page')
+    args = arg_parser.parse_args()
+    for callback, page, parser in parsers:
+        path = getattr(args, page)
+        if not path:
+            continue
+        with open(path, encoding='utf-8') as f:
+            data = f.read()
+        elapsed = timeit.timeit(lambda: parser(data), number=args.number)
+        print('{:<26} {:>10.3f} ms/parse  ({} bytes)'.format(callback, elapsed * 1000 / args.number, len(data)))
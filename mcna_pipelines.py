@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import json
+import sqlite3
+import time
+
+from itemadapter import ItemAdapter
+from scrapy.exceptions import NotConfigured
+from twisted.internet import task
+
+
+class StreamingExportPipeline(object):
+    # Stream member records out as they arrive instead of letting a large run accumulate them. MCNA_EXPORT_URI is
+    # either ndjson:<path>, appending one JSON line per record, or sqlite:<path>, upserting records keyed by
+    # (jobid, subscriber_id). Records are buffered up to MCNA_EXPORT_BATCH and flushed at least every
+    # MCNA_EXPORT_FLUSH_INTERVAL seconds.
+    def __init__(self, uri, batch_size=500, flush_interval=5.0):
+        self.scheme, _, self.path = uri.partition(':')
+        if self.scheme not in ('ndjson', 'sqlite') or not self.path:
+            raise NotConfigured('Unsupported MCNA_EXPORT_URI {}'.format(uri))
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer = []
+        self.flusher = task.LoopingCall(self.flush)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        uri = crawler.settings.get('MCNA_EXPORT_URI')
+        if not uri:
+            raise NotConfigured
+        return cls(uri, crawler.settings.getint('MCNA_EXPORT_BATCH', 500),
+                   crawler.settings.getfloat('MCNA_EXPORT_FLUSH_INTERVAL', 5.0))
+
+    def open_spider(self, spider):
+        if self.scheme == 'ndjson':
+            self.out = open(self.path, 'a', encoding='utf-8')
+        else:
+            self.out = sqlite3.connect(self.path)
+            self.out.execute('CREATE TABLE IF NOT EXISTS members (jobid TEXT, subscriber_id TEXT, data TEXT, '
+                             'updated_at REAL, PRIMARY KEY (jobid, subscriber_id))')
+        self.flusher.start(self.flush_interval, now=False)
+
+    def process_item(self, item, spider):
+        record = ItemAdapter(item).asdict()
+        # Only member records, status events and eligibility notices go through unchanged
+        if record.get('subscriber_id') and record.get('fid'):
+            self.buffer.append(record)
+            if len(self.buffer) >= self.batch_size:
+                self.flush()
+        return item
+
+    def flush(self):
+        if not self.buffer:
+            return
+        records, self.buffer = self.buffer, []
+        if self.scheme == 'ndjson':
+            self.out.write(''.join(json.dumps(r, default=str) + '\n' for r in records))
+            self.out.flush()
+        else:
+            now = time.time()
+            self.out.executemany('INSERT OR REPLACE INTO members VALUES (?, ?, ?, ?)',
+                                 [(r.get('jobid'), r['subscriber_id'], json.dumps(r, default=str), now)
+                                  for r in records])
+            self.out.commit()
+
+    def close_spider(self, spider):
+        if self.flusher.running:
+            self.flusher.stop()
+        self.flush()
+        self.out.close()
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+import argparse
+import os
+import subprocess
+import sys
+import zlib
+
+
+# Stable shard number for a portal account. Every request of one cookiejar session stays in the same shard,
+# so sessions never collide between workers.
+def shard_of(username, shards):
+    return zlib.crc32(username.encode('utf-8')) % shards
+
+
+# Parse the 'index/count' shard spider argument
+def parse_shard(shard):
+    index, count = (int(part) for part in shard.split('/'))
+    if not 0 <= index < count:
+        raise ValueError('Invalid shard {}'.format(shard))
+    return index, count
+
+
+# Run one local `scrapy crawl mcna` process per shard and merge their JSON lines output in shard order.
+# On multiple hosts run the spider with -a shard=<index>/<count> on each and concatenate the outputs the same way.
+def run_shards(shards, spider_args, output):
+    processes = []
+    for index in range(shards):
+        shard_output = '{}.shard{}'.format(output, index)
+        cmd = ['scrapy', 'crawl', 'mcna', '-a', 'shard={}/{}'.format(index, shards), '-O', shard_output + ':jsonlines']
+        for name, value in spider_args.items():
+            cmd += ['-a', '{}={}'.format(name, value)]
+        processes.append((shard_output, subprocess.Popen(cmd)))
+    failed = 0
+    with open(output, 'w', encoding='utf-8') as merged:
+        for shard_output, process in processes:
+            if process.wait() != 0:
+                failed += 1
+            try:
+                with open(shard_output, encoding='utf-8') as f:
+                    for line in f:
+                        merged.write(line)
+            except FileNotFoundError:
+                pass
+    return failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Crawl MCNA with credentials sharded across local processes')
+    parser.add_argument('creds', help='JSON file with the credentials list')
+    parser.add_argument('-n', '--shards', type=int, default=4)
+    parser.add_argument('-m', '--scrape-mode', default='all')
+    parser.add_argument('--members', help='JSON file with partial mode members')
+    parser.add_argument('-o', '--output', default='mcna.jl')
+    args = parser.parse_args()
+    # Workers read the JSON files themselves, large member lists don't fit on a command line
+    spider_args = {'creds': '@' + os.path.abspath(args.creds), 'scrape_mode': args.scrape_mode}
+    if args.members:
+        spider_args['members'] = '@' + os.path.abspath(args.members)
+    sys.exit(1 if run_shards(args.shards, spider_args, args.output) else 0)
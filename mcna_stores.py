@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import sqlite3
+import time
+import zlib
+
+
+# sqlite connection shared by the stores. Several crawls (shards, scheduled jobs, partial jobs next to the bulk
+# sync) may open the same file: WAL lets readers run alongside the writer and writers wait for each other
+# instead of failing.
+def connect(path):
+    db = sqlite3.connect(path, timeout=30)
+    db.execute('PRAGMA journal_mode=WAL')
+    return db
+
+
+class MemberCache(object):
+    # Persistent get_member_info results keyed by (username, fid, mid). An entry is served only while it is
+    # younger than ttl seconds and the roster fields it was fetched with are unchanged. Puts are committed every
+    # commit_every writes and at close.
+    roster_fields = ('fname', 'lname', 'city', 'dentist')
+
+    def __init__(self, path, ttl=86400, commit_every=100):
+        self.db = connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS members (username TEXT, fid TEXT, mid TEXT, subscriber_id TEXT, '
+                        'dob TEXT, roster TEXT, info TEXT, fetched_at REAL, PRIMARY KEY (username, fid, mid))')
+        self.ttl = ttl
+        self.commit_every = commit_every
+        self.uncommitted = 0
+
+    def get(self, item):
+        row = self.db.execute('SELECT roster, info, fetched_at FROM members WHERE username = ? AND fid = ? AND mid = ?',
+                              (item['username'], item['fid'], str(item['mid']))).fetchone()
+        if not row or time.time() - row[2] > self.ttl:
+            return None
+        roster = json.loads(row[0])
+        if any(roster.get(f) != item.get(f) for f in self.roster_fields):
+            return None
+        return json.loads(row[1])
+
+    def put(self, item, info):
+        self.db.execute('INSERT OR REPLACE INTO members VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                        (item['username'], item['fid'], str(item['mid']), str(info.get('subscriber_id')), info.get('dob'),
+                         json.dumps({f: item.get(f) for f in self.roster_fields}), json.dumps(info), time.time()))
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.commit()
+
+    # (subscriber_id, dob) -> mid of the cached members of a facility, dob as member info gave it. Mids don't
+    # change so expired entries count too.
+    def mids(self, username, fid):
+        rows = self.db.execute('SELECT subscriber_id, dob, mid FROM members WHERE username = ? AND fid = ?',
+                               (username, fid)).fetchall()
+        return {(subscriber_id, dob): mid for subscriber_id, dob, mid in rows}
+
+    def commit(self):
+        self.db.commit()
+        self.uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+
+class SessionStore(object):
+    # Authenticated portal cookies per username between runs, Fernet encrypted at rest with the given key
+    def __init__(self, path, key):
+        # Imported here so runs without a session store don't load cryptography
+        try:
+            from cryptography.fernet import Fernet, InvalidToken
+        except ImportError:
+            raise ImportError('cryptography is required for the session store')
+        self.fernet = Fernet(key)
+        self.invalid_token = InvalidToken
+        self.db = connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS sessions (user TEXT PRIMARY KEY, token BLOB, saved_at REAL)')
+
+    @staticmethod
+    def key(username):
+        return hashlib.sha256(username.encode('utf-8')).hexdigest()
+
+    def get(self, username):
+        row = self.db.execute('SELECT token FROM sessions WHERE user = ?', (self.key(username),)).fetchone()
+        if not row:
+            return None
+        try:
+            return json.loads(self.fernet.decrypt(row[0]).decode('utf-8'))
+        except self.invalid_token:
+            return None
+
+    def put(self, username, cookies):
+        self.db.execute('INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)',
+                        (self.key(username), self.fernet.encrypt(json.dumps(cookies).encode('utf-8')), time.time()))
+        self.db.commit()
+
+    def discard(self, username):
+        self.db.execute('DELETE FROM sessions WHERE user = ?', (self.key(username),))
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+class ResponseCache(object):
+    # zlib compressed response bodies in sqlite, expired after ttl seconds and evicted least recently used
+    # first once the stored bodies exceed max_bytes. The stored size is tracked in memory from the total at open,
+    # writes and access times are committed every commit_every changes and at close.
+    def __init__(self, path, ttl=600, max_bytes=256 * 1024 * 1024, commit_every=100):
+        self.db = connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, url TEXT, status INTEGER, '
+                        'content_type TEXT, body BLOB, size INTEGER, stored_at REAL, accessed_at REAL)')
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.total = self.db.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        self.commit_every = commit_every
+        self.uncommitted = 0
+
+    def get(self, key):
+        row = self.db.execute('SELECT url, status, content_type, body, size, stored_at FROM responses WHERE key = ?',
+                              (key,)).fetchone()
+        if not row:
+            return None
+        url, status, content_type, body, size, stored_at = row
+        if time.time() - stored_at > self.ttl:
+            self.db.execute('DELETE FROM responses WHERE key = ?', (key,))
+            self.total -= size
+            self.changed()
+            return None
+        self.db.execute('UPDATE responses SET accessed_at = ? WHERE key = ?', (time.time(), key))
+        self.changed()
+        return url, status, content_type, zlib.decompress(body)
+
+    def put(self, key, url, status, content_type, body):
+        body = zlib.compress(body)
+        now = time.time()
+        replaced = self.db.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+        self.db.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                        (key, url, status, content_type, body, len(body), now, now))
+        self.total += len(body) - (replaced[0] if replaced else 0)
+        if self.total > self.max_bytes:
+            self.evict()
+        self.changed()
+
+    def evict(self):
+        for key, size in self.db.execute('SELECT key, size FROM responses ORDER BY accessed_at').fetchall():
+            self.db.execute('DELETE FROM responses WHERE key = ?', (key,))
+            self.total -= size
+            if self.total <= self.max_bytes:
+                break
+
+    def changed(self):
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        self.db.commit()
+        self.uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+
+class CheckMemo(object):
+    # Checks that succeeded in this run, optionally persisted so a check repeated within ttl seconds is skipped
+    # across runs as well. Checks in flight hold the duplicates that arrived meanwhile, a failed check hands its
+    # key to the next of them so the check is retried rather than lost.
+    def __init__(self, path=None, ttl=86400):
+        self.done = set()
+        self.in_flight = dict()
+        self.db = None
+        if path:
+            self.db = connect(path)
+            self.db.execute('CREATE TABLE IF NOT EXISTS checks (key TEXT PRIMARY KEY, checked_at REAL)')
+        self.ttl = ttl
+
+    @staticmethod
+    def key(*key):
+        return '|'.join(str(k) for k in key)
+
+    # True when the caller should run the check, else it's done already or waiting behind the check in flight
+    def first(self, *key, waiter=None):
+        key = self.key(*key)
+        if key in self.done:
+            return False
+        if key in self.in_flight:
+            if waiter is not None:
+                self.in_flight[key].append(waiter)
+            return False
+        if self.db is not None:
+            row = self.db.execute('SELECT checked_at FROM checks WHERE key = ?', (key,)).fetchone()
+            if row and time.time() - row[0] <= self.ttl:
+                self.done.add(key)
+                return False
+        self.in_flight[key] = []
+        return True
+
+    # The check went through, its waiting duplicates are covered by it
+    def succeeded(self, *key):
+        key = self.key(*key)
+        self.in_flight.pop(key, None)
+        self.done.add(key)
+        if self.db is not None:
+            self.db.execute('INSERT OR REPLACE INTO checks VALUES (?, ?)', (key, time.time()))
+            self.db.commit()
+
+    # The check failed. Returns the waiter that now owns the check and should run it, None when nobody waits.
+    def failed(self, *key):
+        key = self.key(*key)
+        waiters = self.in_flight.pop(key, [])
+        if not waiters:
+            return None
+        self.in_flight[key] = waiters[1:]
+        return waiters[0]
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+
+
+class ProgressStore(object):
+    # Stages a job has completed, so a resumed run only re-enqueues outstanding work. Rows are keyed by
+    # (jobid, username, fid, alpha, mid, stage) with '' for the parts a stage doesn't use, roster rows keep the
+    # fetched members. Marks are committed every commit_every writes and at close.
+    def __init__(self, path, commit_every=100):
+        self.db = connect(path)
+        self.db.execute('CREATE TABLE IF NOT EXISTS progress (jobid TEXT, username TEXT, fid TEXT, alpha TEXT, '
+                        'mid TEXT, stage TEXT, data TEXT, done_at REAL, '
+                        'PRIMARY KEY (jobid, username, fid, alpha, mid, stage))')
+        self.commit_every = commit_every
+        self.uncommitted = 0
+
+    def mark(self, stage, jobid, username, fid='', alpha='', mid='', data=None):
+        self.db.execute('INSERT OR REPLACE INTO progress VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                        (jobid, username, fid, alpha, str(mid), stage,
+                         json.dumps(data) if data is not None else None, time.time()))
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.commit()
+
+    def done(self, stage, jobid, username, fid='', alpha='', mid=''):
+        return self.db.execute('SELECT 1 FROM progress WHERE jobid = ? AND username = ? AND fid = ? AND alpha = ? '
+                               'AND mid = ? AND stage = ?',
+                               (jobid, username, fid, alpha, str(mid), stage)).fetchone() is not None
+
+    # Rosters already fetched for a facility as {alpha: members}
+    def rosters(self, jobid, username, fid):
+        rows = self.db.execute("SELECT alpha, data FROM progress WHERE jobid = ? AND username = ? AND fid = ? "
+                               "AND stage = 'roster'", (jobid, username, fid)).fetchall()
+        return {alpha: json.loads(data) for alpha, data in rows}
+
+    def clear(self, jobid, username):
+        self.db.execute('DELETE FROM progress WHERE jobid = ? AND username = ?', (jobid, username))
+        self.commit()
+
+    def commit(self):
+        self.db.commit()
+        self.uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
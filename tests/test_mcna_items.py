@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest  # noqa: E402
+
+from mcna_items import MemberRecord, StatusEvent  # noqa: E402
+
+
+def test_status_event_carries_ids_not_creds():
+    item = {'creds': {'username': 'bench', 'password': 'secret', 'tmhp_password': 'secret'}, 'jobid': 'job1',
+            'company': 'acme', 'practice': 'main', 'facility_id': 'F1'}
+    event = StatusEvent('Pending', item)
+    assert event == {'jobid': 'job1', 'username': 'bench', 'company': 'acme', 'practice': 'main',
+                     'facility_id': 'F1', 'mco_sync_status': 'Pending'}
+
+
+def test_status_event_one_member():
+    event = StatusEvent('Outdated', {'username': 'bench', 'jobid': 'job1', 'mid': '100001', 'fname': 'first'},
+                        one_member=True)
+    assert event['one_member'] is True
+    assert 'fname' not in event
+
+
+def test_member_record_behaves_like_dict():
+    record = MemberRecord({'username': 'bench', 'mid': '100001'}, plan='CHIP')
+    record['fname'] = 'first'
+    record['source_row'] = 7
+    assert 'fname' in record and 'source_row' in record
+    assert 'lname' not in record and 'other' not in record
+    assert record['source_row'] == 7
+    assert record.get('lname') is None and record.get('lname', '') == ''
+    assert len(record) == 5
+    assert dict(record) == {'username': 'bench', 'mid': '100001', 'fname': 'first', 'plan': 'CHIP', 'source_row': 7}
+    with pytest.raises(KeyError):
+        record['lname']
+    with pytest.raises(KeyError):
+        record['other']
+
+
+def test_member_record_copy_is_independent():
+    record = MemberRecord({'mid': '100001', 'source_row': 7})
+    copy = record.copy()
+    copy['mid'] = '100002'
+    copy['source_row'] = 8
+    copy['dob'] = '01/02/2010'
+    assert dict(record) == {'mid': '100001', 'source_row': 7}
+    assert dict(copy) == {'mid': '100002', 'dob': '01/02/2010', 'source_row': 8}
+
+
+def test_member_record_pop():
+    record = MemberRecord({'mid': '100001', 'source_row': 7})
+    assert record.pop('mid') == '100001'
+    assert record.pop('source_row') == 7
+    assert 'mid' not in record and len(record) == 0
+    assert record.pop('mid', None) is None
+    assert record.pop('other', 'x') == 'x'
+    with pytest.raises(KeyError):
+        record.pop('mid')
+    with pytest.raises(KeyError):
+        record.pop('other')
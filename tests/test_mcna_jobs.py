@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import types
+
+import pytest
+
+pytest.importorskip('scrapy')
+
+# mcna_jobs imports its siblings relatively, load the directory as a package
+package = types.ModuleType('mcna_spiders')
+package.__path__ = [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))]
+sys.modules.setdefault('mcna_spiders', package)
+
+from mcna_spiders.mcna_jobs import JobScheduler  # noqa: E402
+
+
+def submit(scheduler, name, scrape_mode, age=0):
+    job = scheduler.submit(name, {'scrape_mode': scrape_mode}, name + '.jl')
+    job.submitted_at -= age
+    return job
+
+
+def start(scheduler, job):
+    # Stands in for JobScheduler.start without a crawl process
+    scheduler.running.append(job)
+
+
+def test_interactive_jobs_start_first():
+    scheduler = JobScheduler(workers=4, interactive_workers=1, max_bulk_wait=900)
+    submit(scheduler, 'sync', 'all', age=60)
+    submit(scheduler, 'check', 'partial')
+    assert scheduler.next_job().name == 'check'
+    assert scheduler.next_job().name == 'sync'
+    assert scheduler.next_job() is None
+    assert 'mcna/jobs/bulk/promoted' not in scheduler.stats
+
+
+def test_bulk_job_promoted_after_max_wait():
+    scheduler = JobScheduler(workers=4, interactive_workers=1, max_bulk_wait=900)
+    submit(scheduler, 'sync', 'all', age=901)
+    submit(scheduler, 'check', 'validate')
+    assert scheduler.next_job().name == 'sync'
+    assert scheduler.stats['mcna/jobs/bulk/promoted'] == 1
+    assert scheduler.next_job().name == 'check'
+
+
+def test_bulk_jobs_leave_reserved_workers():
+    scheduler = JobScheduler(workers=2, interactive_workers=1, max_bulk_wait=900)
+    start(scheduler, submit(scheduler, 'sync1', 'all'))
+    submit(scheduler, 'sync2', 'all', age=901)
+    assert scheduler.next_job() is None
+    submit(scheduler, 'check', 'partial')
+    assert scheduler.next_job().name == 'check'
+    assert 'mcna/jobs/bulk/promoted' not in scheduler.stats
+
+
+def test_bulk_jobs_need_a_shared_worker():
+    with pytest.raises(ValueError):
+        JobScheduler(workers=2, interactive_workers=2)
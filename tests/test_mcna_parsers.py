@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mcna_parsers  # noqa: E402
+
+bs4 = pytest.importorskip('bs4')
+
+fixtures = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+
+def fixture(name):
+    with open(os.path.join(fixtures, name), encoding='utf-8') as f:
+        return f.read()
+
+
+# The BeautifulSoup and regex extraction parse_member_eligibility did before parse_eligibility_page,
+# returning what it put on the item. Missing status lines ended it with an AttributeError after the plan.
+def soup_eligibility(data):
+    soup = bs4.BeautifulSoup(data, 'lxml')
+    plan = re.search(r'<div class="eligLabel">Plan:</div>(.*)</div>', data)
+    result = {'plan': plan.group(1) if plan else '', 'active': None, 'eligible': None}
+    eg_date = re.search(r'This member is on the .* plan and became eligible for benefits on (\d+/\d+/\d+).', data)
+    try:
+        active = 'active' in re.search(r'This member is currently .*', data).group(0)
+        eligible = 'eligible' in re.search(r'Subscriber is .*', data).group(0)[:-5].lower()
+    except AttributeError:
+        return result
+    result['active'], result['eligible'] = active, eligible
+    result['became_eligible_on'] = eg_date.group(1) if eg_date else ''
+    confirmation_no = re.search(r'Confirmation: (#\d+)<br/>', data)
+    result['confirmation_no'] = confirmation_no.group(1) if confirmation_no else ''
+
+    services_table = soup.find_all('table', class_='services')[-1]
+    service_date = services_table.find('td')
+    result['last_service_date'] = service_date.text if service_date else ''
+
+    last_prophylaxis_date = ''
+    rows = []
+    prophylaxis_child = soup.find('td', title='PROPHYLAXIS - CHILD')
+    prophylaxis_adult = soup.find('td', title='PROPHYLAXIS - ADULT')
+    if prophylaxis_adult:
+        rows = prophylaxis_adult.find_all_previous('tr')
+    elif prophylaxis_child:
+        rows = prophylaxis_child.find_all_previous('tr')
+    for row in rows:
+        if row.find('td'):
+            if row.td.text != '':
+                last_prophylaxis_date = row.td.text
+                break
+    result['last_prophylaxis_date'] = last_prophylaxis_date
+
+    print_link = soup.find('a', string='Print Eligibility Confirmation')
+    result['print_link'] = print_link['href'] if print_link else None
+    return result
+
+
+@pytest.mark.parametrize('name', ['eligibility_adult.html', 'eligibility_child.html', 'eligibility_no_status.html',
+                                  'eligibility_minified.html'])
+def test_eligibility_page_matches_soup(name):
+    data = fixture(name)
+    assert mcna_parsers.parse_eligibility_page(data) == soup_eligibility(data)
+
+
+def test_eligibility_page_without_services_table_fails_like_soup():
+    data = fixture('eligibility_no_services.html')
+    with pytest.raises(IndexError):
+        soup_eligibility(data)
+    with pytest.raises(IndexError):
+        mcna_parsers.parse_eligibility_page(data)
+
+
+def test_adult_prophylaxis_takes_precedence():
+    eligibility = mcna_parsers.parse_eligibility_page(fixture('eligibility_adult.html'))
+    # The adult row and the one before it have no date, the child row above them does
+    assert eligibility['last_prophylaxis_date'] == '06/10/2021'
+    assert eligibility['last_service_date'] == '06/10/2021'
+    assert (eligibility['active'], eligibility['eligible']) == (True, True)
+
+
+def test_child_prophylaxis():
+    eligibility = mcna_parsers.parse_eligibility_page(fixture('eligibility_child.html'))
+    assert eligibility['last_prophylaxis_date'] == '03/22/2021'
+    assert eligibility['last_service_date'] == '09/14/2021'
+    assert (eligibility['active'], eligibility['eligible']) == (False, False)
+
+
+def test_missing_status_line_keeps_plan_only():
+    eligibility = mcna_parsers.parse_eligibility_page(fixture('eligibility_no_status.html'))
+    assert eligibility == {'plan': 'Texas Medicaid CHIP', 'active': None, 'eligible': None}
+
+
+def test_minified_page_matches_to_end_of_line():
+    data = fixture('eligibility_minified.html')
+    assert data.count('\n') == 1
+    eligibility = mcna_parsers.parse_eligibility_page(data)
+    # Like the old greedy patterns, the plan runs to the last </div> on the line and the subscriber status
+    # takes in the rest of the page
+    assert eligibility['plan'].endswith('All rights reserved.</p>')
+    assert eligibility['eligible'] is True
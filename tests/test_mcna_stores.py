@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mcna_stores  # noqa: E402
+from mcna_stores import CheckMemo, ProgressStore, ResponseCache  # noqa: E402
+
+
+def test_duplicate_waits_on_check_in_flight():
+    memo = CheckMemo()
+    assert memo.first('500001', '01/02/2010', waiter='a')
+    assert not memo.first('500001', '01/02/2010', waiter='b')
+    memo.succeeded('500001', '01/02/2010')
+    assert not memo.first('500001', '01/02/2010', waiter='c')
+
+
+def test_failed_check_passes_to_next_waiter():
+    memo = CheckMemo()
+    memo.first('500001', '01/02/2010', waiter='a')
+    memo.first('500001', '01/02/2010', waiter='b')
+    memo.first('500001', '01/02/2010', waiter='c')
+    assert memo.failed('500001', '01/02/2010') == 'b'
+    assert memo.failed('500001', '01/02/2010') == 'c'
+    assert memo.failed('500001', '01/02/2010') is None
+    # Nobody holds the check any more, the next caller runs it
+    assert memo.first('500001', '01/02/2010', waiter='d')
+
+
+def test_only_successful_checks_persist(tmp_path):
+    path = str(tmp_path / 'memo')
+    memo = CheckMemo(path)
+    memo.first('500001', '01/02/2010')
+    memo.failed('500001', '01/02/2010')
+    memo.first('500002', '01/02/2010')
+    memo.succeeded('500002', '01/02/2010')
+    memo.close()
+
+    memo = CheckMemo(path)
+    assert memo.first('500001', '01/02/2010')
+    assert not memo.first('500002', '01/02/2010')
+    memo.close()
+
+
+class Clock(object):
+    # Stands in for the time module in mcna_stores
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+
+def test_response_cache_expires_after_ttl(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(mcna_stores, 'time', clock)
+    cache = ResponseCache(str(tmp_path / 'cache'), ttl=60)
+    cache.put('k', 'https://portal.mcna.net/e', 200, 'text/html', b'body')
+    clock.now += 60
+    assert cache.get('k') == ('https://portal.mcna.net/e', 200, 'text/html', b'body')
+    clock.now += 1
+    assert cache.get('k') is None
+    assert cache.total == 0
+    cache.close()
+
+
+def test_response_cache_evicts_least_recently_used(tmp_path, monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(mcna_stores, 'time', clock)
+    body = bytes(range(256)) * 4
+    cache = ResponseCache(str(tmp_path / 'cache'))
+    cache.put('a', 'https://portal.mcna.net/a', 200, 'text/html', body)
+    size = cache.total
+    cache.max_bytes = 2 * size
+    clock.now += 1
+    cache.put('b', 'https://portal.mcna.net/b', 200, 'text/html', body)
+    clock.now += 1
+    # Reading a makes b the least recently used
+    assert cache.get('a') is not None
+    clock.now += 1
+    cache.put('c', 'https://portal.mcna.net/c', 200, 'text/html', body)
+    assert cache.get('b') is None
+    assert cache.get('a') is not None and cache.get('c') is not None
+    assert cache.total == 2 * size
+    cache.close()
+
+    # The stored size is picked up again at open
+    cache = ResponseCache(str(tmp_path / 'cache'))
+    assert cache.total == 2 * size
+    cache.close()
+
+
+def test_progress_resumes_rosters_and_stages(tmp_path):
+    path = str(tmp_path / 'progress')
+    progress = ProgressStore(path)
+    progress.mark('roster', 'job1', 'bench', 'F1', 'A', data=[{'mid': '100001', 'lname': 'Adams'}])
+    progress.mark('roster', 'job1', 'bench', 'F1', 'B', data=[])
+    progress.mark('roster', 'job1', 'bench', 'F2', 'A', data=[{'mid': '100002', 'lname': 'Abbot'}])
+    progress.mark('member', 'job1', 'bench', 'F1', mid=100001)
+    progress.close()
+
+    # Marks are committed at close, a resumed run picks them up
+    progress = ProgressStore(path)
+    assert progress.rosters('job1', 'bench', 'F1') == {'A': [{'mid': '100001', 'lname': 'Adams'}], 'B': []}
+    assert progress.rosters('job2', 'bench', 'F1') == {}
+    assert progress.done('member', 'job1', 'bench', 'F1', mid='100001')
+    assert not progress.done('member', 'job1', 'bench', 'F1', mid='100002')
+    assert not progress.done('facility', 'job1', 'bench', 'F1')
+    progress.clear('job1', 'bench')
+    assert progress.rosters('job1', 'bench', 'F1') == {}
+    assert not progress.done('member', 'job1', 'bench', 'F1', mid='100001')
+    progress.close()